@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# Back up several accounts with one multi-account config against the fake
+# VK API that limits requests per token; compare with one account: every
+# account has its own rate limit, so the throughput grows with the number
+# of accounts up to "max_concurrent_accounts". All accounts see the same
+# synthetic archive, so their participants are shared and must be
+# downloaded once.
+
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+
+from fake_vk_api import fake_vk_api
+from synthetic import make_archive
+
+
+script = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'vk_messages_backup.py')
+
+
+def run(api, tmp_dir, accounts_cnt, max_concurrent, requests_per_second):
+    config = {
+        'api_url': api.url,
+        'requests_per_second': requests_per_second,
+        'max_concurrent_accounts': max_concurrent,
+        'accounts': [{'access_token': 'token%d' % i, 'user_id': 1,
+                      'name': 'account%d' % i}
+                     for i in range(accounts_cnt)],
+    }
+    run_dir = tempfile.mkdtemp(dir=tmp_dir)
+    config_file = os.path.join(run_dir, 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    stats_before = dict(api.stats)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, script, '--quiet', '--config',
+                    config_file, '--storage', os.path.join(run_dir, 'storage'),
+                    '--chatlogs', os.path.join(run_dir, 'chatlogs')],
+                   check=True)
+    elapsed = time.perf_counter() - start
+    calls = {method: count - stats_before.get(method, 0)
+             for method, count in api.stats.items()}
+    return elapsed, calls
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark multi-account backups')
+    parser.add_argument('--dialogs', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--groupchats', type=int, default=20)
+    parser.add_argument('--accounts', type=int, default=4)
+    parser.add_argument('--max-concurrent', type=int, default=4)
+    parser.add_argument('--requests-per-second', type=float, default=3)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    archive = make_archive(args.dialogs, args.messages, args.groupchats)
+    api = fake_vk_api(archive, latency=args.latency,
+                      requests_per_second=int(args.requests_per_second) +
+                      1).start()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for accounts_cnt in (1, args.accounts):
+            elapsed, calls = run(api, tmp_dir, accounts_cnt,
+                                 args.max_concurrent,
+                                 args.requests_per_second)
+            print('%d account(s): %.2f s, %.0f messages/s, users.get %d' %
+                  (accounts_cnt, elapsed,
+                   accounts_cnt * len(archive) / elapsed,
+                   calls.get('users.get', 0)))
+    api.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# Run vk_messages_backup.py --daemon against the fake VK API, add batches
+# of messages and measure how soon they are stored and rendered (the
+# daemon writes --metrics after every update); without the long poll the
+# daemon checks for messages every --poll-interval seconds.
+
+import os
+import sys
+import json
+import time
+import signal
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+
+from fake_vk_api import fake_vk_api
+from synthetic import make_archive
+
+
+script = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'vk_messages_backup.py')
+
+
+def added_messages(metrics_file):
+    if not os.path.isfile(metrics_file):
+        return None
+    with open(metrics_file, 'r') as f:
+        return json.load(f).get('messages_added_total', 0)
+
+
+def wait_added(metrics_file, count, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        added = added_messages(metrics_file)
+        if added is not None and added >= count:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the daemon mode')
+    parser.add_argument('--dialogs', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--groupchats', type=int, default=10)
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=5)
+    parser.add_argument('--no-long-poll', action='store_true')
+    parser.add_argument('--poll-interval', type=float, default=1)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    total = args.messages + args.batches * args.batch_size
+    archive = make_archive(args.dialogs, total, args.groupchats)
+    api = fake_vk_api(archive[:args.messages],
+                      long_poll=not args.no_long_poll).start()
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_file = os.path.join(tmp_dir, 'config.json')
+        with open(config_file, 'w') as f:
+            json.dump(api.config(requests_per_second=100), f)
+        metrics_file = os.path.join(tmp_dir, 'metrics.json')
+        daemon = subprocess.Popen(
+            [sys.executable, script, '--quiet', '--config', config_file,
+             '--storage', os.path.join(tmp_dir, 'storage'),
+             '--chatlogs', os.path.join(tmp_dir, 'chatlogs'),
+             '--metrics', metrics_file, '--daemon',
+             '--poll-interval', str(args.poll_interval)])
+        try:
+            start = time.perf_counter()
+            if not wait_added(metrics_file, args.messages, args.timeout):
+                raise NameError('main: initial backup is not done')
+            print('initial backup: %.2f s' % (time.perf_counter() - start))
+            for i in range(args.batches):
+                first = args.messages + i * args.batch_size
+                start = time.perf_counter()
+                api.add_messages(archive[first:first + args.batch_size])
+                if not wait_added(metrics_file, first + args.batch_size,
+                                  args.timeout):
+                    raise NameError('main: batch %d is not stored' % i)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            daemon.send_signal(signal.SIGTERM)
+            daemon.wait()
+            api.stop()
+    latencies.sort()
+    print('%d batches of %d messages stored and rendered in: '
+          'median %.3f s, max %.3f s' % (
+              len(latencies), args.batch_size,
+              latencies[len(latencies) // 2], latencies[-1]))
+    print('API calls: %s' % ', '.join(
+        '%s %d' % item for item in sorted(api.stats.items())))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Measure chatlog rendering throughput of one big synthetic dialog.
+
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+
+from synthetic import make_dialog_messages, make_users_dict
+from vk_messages_backup import vk_dialog, jsonl_storage_backend
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark vk_dialog.dump()')
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='report peak memory of the dump itself')
+    args = parser.parse_args()
+
+    user_id = 2
+    messages = make_dialog_messages(args.messages, user_id)
+    users_dict = make_users_dict([user_id])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dialog = vk_dialog((False, user_id), jsonl_storage_backend(tmp_dir))
+        dialog.load()
+        for msg in messages:
+            dialog.add_message(msg)
+        dialog.sort()
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        start = time.perf_counter()
+        dialog.dump(tmp_dir, users_dict)
+        elapsed = time.perf_counter() - start
+        if args.tracemalloc:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        size = os.path.getsize(
+            os.path.join(tmp_dir, dialog.dump_filename(users_dict)))
+    print('messages: %d' % args.messages)
+    print('chatlog size: %.1f MiB' % (size / 2**20))
+    print('time: %.2f s' % elapsed)
+    print('throughput: %.0f messages/s' % (args.messages / elapsed))
+    if args.tracemalloc:
+        print('peak memory during dump: %.1f MiB' % (peak / 2**20))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Download from the fake VK API that fails a part of requests: every
+# message must be stored once, retries and errors are counted by kinds;
+# then a fatal error (captcha) must stop the download without retries.
+
+import os
+import sys
+import json
+import time
+import logging
+import tempfile
+from argparse import ArgumentParser
+
+from fake_vk_api import fake_vk_api
+from synthetic import make_archive
+from vk_messages_backup import vk_api, vk_api_error, vk_messages_storage, \
+    vk_users_storage, run_metrics, download_concurrent
+
+
+def open_vk(config_file, retry_base_delay):
+    vk = vk_api(config_file)
+    vk.retry_base_delay = retry_base_delay
+    return vk
+
+
+def main():
+    parser = ArgumentParser(
+        description='Benchmark vk_api.do_request() against failing requests')
+    parser.add_argument('--dialogs', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--groupchats', type=int, default=5)
+    parser.add_argument('--fault-rate', type=float, default=0.2)
+    parser.add_argument('--requests-per-second', type=float, default=50)
+    parser.add_argument('--retry-base-delay', type=float, default=0.05,
+                        help='seconds (default: %(default)s)')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    archive = make_archive(args.dialogs, args.messages, args.groupchats)
+    api = fake_vk_api(archive, fault_rate=args.fault_rate).start()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_file = os.path.join(tmp_dir, 'config.json')
+        with open(config_file, 'w') as f:
+            json.dump(api.config(
+                requests_per_second=args.requests_per_second), f)
+        storage_dir = os.path.join(tmp_dir, 'storage')
+        vk = open_vk(config_file, args.retry_base_delay)
+        vk.metrics = run_metrics()
+        storage = vk_messages_storage(storage_dir, storage_dir)
+        storage.metrics = vk.metrics
+        users_storage = vk_users_storage(storage_dir)
+        start = time.perf_counter()
+        download_concurrent(vk, storage, users_storage)
+        elapsed = time.perf_counter() - start
+        storage.save()
+        count = sum(dialog.count for dialog in storage.dialogs.values())
+        storage.close()
+        report = vk.metrics.report()
+
+        print('time: %.2f s, %d of %d messages stored' %
+              (elapsed, count, len(archive)))
+        print('injected: %s' % ', '.join(
+            '%s %d' % item for item in sorted(api.fault_stats.items())))
+        print('errors: %s' % ', '.join(
+            '%s %d' % item
+            for item in sorted(report.get('api_error_kinds_total',
+                                          {}).items())))
+        print('retries: %d, rate limit slowdowns: %d, final rate: %.1f/s' % (
+            sum(report.get('api_retries_total', {}).values()),
+            report.get('rate_limit_slowdowns_total', 0), vk.limiter.rate))
+
+        # a fatal error is not retried
+        api.fault_rate = 0
+        api.inject('captcha')
+        vk = open_vk(config_file, args.retry_base_delay)
+        requests_before = api.http_requests
+        try:
+            vk.do_request('users.get', {'user_ids': '1'})
+            fatal = 'not raised'
+        except vk_api_error as e:
+            fatal = '%s after %d request(s)' % (
+                e.kind, api.http_requests - requests_before)
+        print('captcha: %s' % fatal)
+    api.stop()
+    return 0 if count == len(archive) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
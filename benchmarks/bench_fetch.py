@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# Compare sequential and concurrent download against the fake VK API.
+
+import os
+import sys
+import json
+import time
+import tempfile
+from argparse import ArgumentParser
+
+from fake_vk_api import fake_vk_api
+from synthetic import make_archive
+from vk_messages_backup import vk_api, vk_messages_storage, \
+    vk_users_storage, download_sequential, download_concurrent
+
+
+def run(download, api, config, tmp_dir):
+    config_file = os.path.join(tmp_dir, 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    storage_dir = tempfile.mkdtemp(dir=tmp_dir)
+    vk = vk_api(config_file)
+    storage = vk_messages_storage(storage_dir, storage_dir)
+    users_storage = vk_users_storage(storage_dir)
+    requests_before = api.http_requests
+    start = time.perf_counter()
+    download(vk, storage, users_storage)
+    elapsed = time.perf_counter() - start
+    return elapsed, api.http_requests - requests_before
+
+
+def main():
+    parser = ArgumentParser(
+        description='Benchmark download_sequential() against '
+                    'download_concurrent()')
+    parser.add_argument('--dialogs', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--groupchats', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=1.0,
+                        help='seconds per request (default: %(default)s)')
+    parser.add_argument('--requests-per-second', type=float, default=3)
+    parser.add_argument('--use-execute', action='store_true')
+    args = parser.parse_args()
+
+    archive = make_archive(args.dialogs, args.messages, args.groupchats)
+    api = fake_vk_api(archive, latency=args.latency).start()
+    config = api.config(requests_per_second=args.requests_per_second,
+                        use_execute=args.use_execute)
+    bound = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, download in (('sequential', download_sequential),
+                               ('concurrent', download_concurrent)):
+            elapsed, requests_cnt = run(download, api, config, tmp_dir)
+            bound = requests_cnt / args.requests_per_second
+            print('%s: %.2f s, %d requests' % (name, elapsed, requests_cnt))
+    print('rate limit bound: %.2f s' % bound)
+    api.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
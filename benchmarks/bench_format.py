@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# Compare vk_message_formatter against the per-message formatting it
+# replaced: the output must be the same, only faster. Zones with DST
+# changes (and the half-hour one of Lord Howe) are checked along with the
+# default fixed offset.
+
+import sys
+import time
+from datetime import datetime
+from argparse import ArgumentParser
+
+from synthetic import make_dialog_messages, make_users_dict, my_id
+from vk_messages_backup import create_timezone, vk_message, \
+    vk_message_formatter
+
+
+# vk_message.format() before vk_message_formatter, kept as the reference
+
+def reference_format(m, users_dict, tz):
+    def format_timestamp(msg):
+        return datetime.fromtimestamp(msg['date'], tz).isoformat(' ')
+
+    def format_username_by_id(user_id):
+        if user_id in users_dict:
+            return str(users_dict[user_id])
+        else:
+            return 'user_' + str(user_id)
+
+    def format_username(msg):
+        if 'out' in msg and msg['out']:
+            user_id = 'me'
+        else:
+            user_id = msg['user_id']
+        return format_username_by_id(user_id)
+
+    def format_forward(msg):
+        fwd = ''
+        if 'fwd_messages' in msg:
+            fwd_mark = '>>> '
+            fwd_template = '\n' + fwd_mark + '[%s] %s:%s'
+            for fwd_msg in msg['fwd_messages']:
+                fwd_timestamp = format_timestamp(fwd_msg)
+                fwd_username = format_username(fwd_msg)
+                fwd_body = (format_forward(fwd_msg) + fwd_msg['body'])
+                fwd_body = fwd_body.replace('\n', '\n' + fwd_mark)
+                fwd += fwd_template % (
+                    fwd_timestamp, fwd_username, fwd_body)
+        if len(fwd) == 0:
+            fwd += ' '
+        else:
+            fwd += '\n'
+        return fwd
+
+    def format_action(msg):
+        if 'action' in msg:
+            action_mark_left = '*** ['
+            action_mark_right = '] ***'
+            if 'action_mid' in msg:
+                if int(msg['action_mid']) > 0:
+                    act_username = format_username_by_id(
+                        int(msg['action_mid']))
+                else:
+                    act_username = msg['action_email']
+            if msg['action'] == 'chat_photo_update':
+                action = 'chat photo updated'
+            elif msg['action'] == 'chat_photo_remove':
+                action = 'chat photo removed'
+            elif msg['action'] == 'chat_create':
+                action = 'chat created: ' + msg['action_text']
+            elif msg['action'] == 'chat_title_update':
+                action = 'chat title updated: ' + msg['action_text']
+            elif msg['action'] == 'chat_invite_user':
+                action = 'user invited: ' + act_username
+            elif msg['action'] == 'chat_kick_user':
+                action = 'user kicked: ' + act_username
+            else:
+                raise NameError('reference_format.format_action: '
+                                'unsupported action type')
+            return action_mark_left + action + action_mark_right
+        else:
+            return ''
+
+    template = '%s[%s] %s:%s%s%s'
+    title = ''
+    more = ''
+
+    # timestamp, username, body
+    timestamp = format_timestamp(m)
+    username = format_username(m)
+    body = m['body']
+    # forward messages if exists
+    fwd = format_forward(m)
+    # title if not groupchat message and exists
+    if 'chat_id' not in m and m['title'].strip() != '...':
+        title = m['title'] + '\n'
+
+    # action if exists
+    more += format_action(m)
+    # geolocation if exists
+    if 'geo' in m:
+        more += '\n    <- ' \
+            'geolocation attached but displaying is not implemented'
+    # media attachments if exists
+    if 'attachments' in m:
+        more += '\n    <- ' \
+            'media attachments attached but displaying is not implemented'
+
+    return template % (title, timestamp, username, fwd, body, more)
+
+
+# some service messages and authors missing in users_dict
+def add_actions(messages, chat_id):
+    actions = [
+        {'action': 'chat_create', 'action_text': 'Chat'},
+        {'action': 'chat_title_update', 'action_text': 'New title'},
+        {'action': 'chat_photo_update'},
+        {'action': 'chat_photo_remove'},
+        {'action': 'chat_invite_user', 'action_mid': 3},
+        {'action': 'chat_kick_user', 'action_mid': -1,
+         'action_email': 'someone@example.com'},
+    ]
+    for i in range(0, len(messages), 100):
+        raw = messages[i].raw()
+        raw.update(actions[i // 100 % len(actions)])
+        raw['user_id'] = 100000 + i // 100 % 7
+        raw['out'] = 0
+        if i // 100 % 3 == 0:
+            raw['attachments'] = []
+            raw['geo'] = {}
+        messages[i] = vk_message(raw)
+
+
+def measure(func, messages):
+    start = time.perf_counter()
+    res = func(messages)
+    return time.perf_counter() - start, res
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark vk_message_formatter')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--timezone', action='append',
+                        help='IANA timezone to check, may be repeated '
+                             '(default: UTC+3 and several DST zones)')
+    args = parser.parse_args()
+
+    user_id = 2
+    chat_id = 10
+    half = args.messages // 2
+    messages = make_dialog_messages(half, user_id) + \
+        make_dialog_messages(args.messages - half, user_id, chat_id=chat_id,
+                             first_id=half + 1, seed=1)
+    add_actions(messages, chat_id)
+    users_dict = make_users_dict([user_id, my_id])
+
+    print('messages: %d' % args.messages)
+    res = 0
+    for name in args.timezone or default_timezones:
+        if run(name, messages, users_dict) != 0:
+            res = 1
+    return res
+
+
+default_timezones = [None, 'Europe/Moscow', 'Europe/Berlin',
+                     'America/New_York', 'Australia/Lord_Howe']
+
+
+def run(name, messages, users_dict):
+    tz = create_timezone(name)
+
+    def reference(messages):
+        return [reference_format(msg.raw(), users_dict, tz)
+                for msg in messages]
+
+    def formatter(messages):
+        f = vk_message_formatter(users_dict, tz)
+        return [msg.format(users_dict, f) for msg in messages]
+
+    reference_time, expected = measure(reference, messages)
+    formatter_time, got = measure(formatter, messages)
+
+    print('%s:' % (name or 'UTC+3'))
+    print('  reference: %.2f s (%.0f messages/s)' %
+          (reference_time, len(messages) / reference_time))
+    print('  formatter: %.2f s (%.0f messages/s)' %
+          (formatter_time, len(messages) / formatter_time))
+    print('  speedup: %.2fx' % (reference_time / formatter_time))
+    mismatch = [i for i, (a, b) in enumerate(zip(expected, got)) if a != b]
+    if len(mismatch) > 0:
+        print('  output differs for %d messages, first: %r != %r' %
+              (len(mismatch), expected[mismatch[0]], got[mismatch[0]]))
+        return 1
+    print('  output is identical')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Measure the heap taken by loaded messages with tracemalloc: vk_message
+# objects against the plain decoded dicts they replaced. Exits with 1 when
+# a message takes more than --max-bytes.
+
+import os
+import sys
+import json
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+
+from synthetic import make_archive
+from vk_messages_backup import vk_message, vk_messages_storage
+
+
+def measure(func):
+    tracemalloc.start()
+    res = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, res
+
+
+def load_dicts(storage_dir):
+    res = []
+    for filename in sorted(os.listdir(storage_dir)):
+        if filename.endswith('.jsonl'):
+            with open(os.path.join(storage_dir, filename), 'rb') as f:
+                res.append([json.loads(line) for line in f])
+    return res
+
+
+def load_messages(storage_dir):
+    storage = vk_messages_storage(storage_dir, storage_dir)
+    storage.search_index.is_disabled = True
+    storage.load()
+    for dialog in storage.dialogs.values():
+        dialog.load()
+    return storage
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark memory per message')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--dialogs', type=int, default=200)
+    parser.add_argument('--max-bytes', type=int, default=600,
+                        help='fail above that many bytes per message '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as storage_dir:
+        storage = vk_messages_storage(storage_dir, storage_dir)
+        storage.search_index.is_disabled = True
+        storage.add_messages(vk_message(m) for m in
+                             make_archive(args.dialogs, args.messages,
+                                          groupchats=args.dialogs // 10))
+        storage.save()
+        storage.close()
+
+        dicts_size, dicts = measure(lambda: load_dicts(storage_dir))
+        del dicts
+        messages_size, storage = measure(lambda: load_messages(storage_dir))
+        storage.close()
+
+    print('messages: %d' % args.messages)
+    print('decoded dicts: %.0f bytes per message' %
+          (dicts_size / args.messages))
+    print('vk_message: %.0f bytes per message' %
+          (messages_size / args.messages))
+    if messages_size / args.messages > args.max_bytes:
+        print('more than %d bytes per message' % args.max_bytes)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Add pages of messages (partly overlapping) to a loaded dialog and read
+# it after every page, as storing, searching and rendering do; compare with
+# appending and sorting the whole list each time.
+
+import sys
+import time
+import tempfile
+from operator import attrgetter
+from argparse import ArgumentParser
+
+from synthetic import make_dialog_messages
+from vk_messages_backup import vk_dialog, jsonl_storage_backend
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark vk_dialog merging')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--page-size', type=int, default=200)
+    args = parser.parse_args()
+
+    user_id = 2
+    total = args.messages + args.pages * args.page_size
+    messages = make_dialog_messages(total, user_id)
+    old, new = messages[:args.messages], messages[args.messages:]
+    # every page repeats the last quarter of the previous one
+    overlap = args.page_size // 4
+    pages = []
+    for i in range(args.pages):
+        start = max(0, i * args.page_size - overlap)
+        pages.append(new[start:(i + 1) * args.page_size])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dialog = vk_dialog((False, user_id), jsonl_storage_backend(tmp_dir))
+        dialog.load()
+        for msg in old:
+            dialog.add_message(msg)
+        start_time = time.perf_counter()
+        for page in pages:
+            # VK returns pages newest first
+            for msg in reversed(page):
+                dialog.add_message(msg)
+            dialog.get_messages()
+        merge_time = time.perf_counter() - start_time
+        count = len(dialog.get_messages())
+
+    res = list(old)
+    start_time = time.perf_counter()
+    for page in pages:
+        res.extend(reversed(page))
+        res.sort(key=attrgetter('m_date'))
+    sort_time = time.perf_counter() - start_time
+
+    print('messages: %d, then %d pages of %d' %
+          (args.messages, args.pages, args.page_size))
+    print('merge: %.2f s, %d messages kept' % (merge_time, count))
+    print('append and sort: %.2f s, %d messages kept' %
+          (sort_time, len(res)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Render a synthetic archive serially and with a process pool, compare
+# times and check that the chatlogs are byte-identical.
+
+import os
+import sys
+import time
+import filecmp
+import tempfile
+from argparse import ArgumentParser
+
+from synthetic import make_archive, make_users_dict
+from vk_messages_backup import vk_message, vk_messages_storage
+
+
+def render(storage_dir, dump_dir, users_dict, storage_format, jobs):
+    storage = vk_messages_storage(storage_dir, dump_dir, storage_format)
+    storage.load()
+    start = time.perf_counter()
+    storage.dump(users_dict, jobs)
+    elapsed = time.perf_counter() - start
+    storage.close()
+    return elapsed
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark vk_messages_storage.dump() '
+                                        'with --jobs')
+    parser.add_argument('--dialogs', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=300000)
+    parser.add_argument('--groupchats', type=int, default=10)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--storage-format', default='jsonl')
+    args = parser.parse_args()
+
+    archive = make_archive(args.dialogs, args.messages, args.groupchats)
+    users_ids = set()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        storage_dir = os.path.join(tmp_dir, 'storage')
+        storage = vk_messages_storage(storage_dir, tmp_dir,
+                                      args.storage_format)
+        for raw_msg in archive:
+            msg = vk_message(raw_msg)
+            users_ids.update(msg.participants())
+            storage.add_message(msg)
+        storage.save()
+        storage.close()
+        users_dict = make_users_dict(users_ids)
+
+        serial_dir = os.path.join(tmp_dir, 'serial')
+        parallel_dir = os.path.join(tmp_dir, 'parallel')
+        serial = render(storage_dir, serial_dir, users_dict,
+                        args.storage_format, 1)
+        parallel = render(storage_dir, parallel_dir, users_dict,
+                          args.storage_format, args.jobs)
+
+        filenames = sorted(os.listdir(serial_dir))
+        _, mismatch, errors = filecmp.cmpfiles(
+            serial_dir, parallel_dir, filenames, shallow=False)
+        if sorted(os.listdir(parallel_dir)) != filenames:
+            errors.append('different sets of chatlogs')
+    print('serial: %.2f s' % serial)
+    print('%d jobs: %.2f s' % (args.jobs, parallel))
+    if mismatch or errors:
+        print('chatlogs differ: %s' % (mismatch + errors))
+        return 1
+    print('%d chatlogs are byte-identical' % len(filenames))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
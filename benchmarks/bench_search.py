@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Measure the search index: how long it takes to build and to query,
+# compared with scanning the rendered chatlogs like grep does.
+
+import os
+import re
+import sys
+import time
+import tempfile
+from argparse import ArgumentParser
+
+from synthetic import make_archive, make_users_dict
+from vk_messages_backup import vk_message, vk_messages_storage, \
+    vk_search_index
+
+
+def timed(func):
+    start = time.perf_counter()
+    res = func()
+    return time.perf_counter() - start, res
+
+
+# the number of matching lines
+def grep_chatlogs(dump_dir, words):
+    regexps = [re.compile(r'\b%s\b' % re.escape(word)) for word in words]
+    res = 0
+    for filename in os.listdir(dump_dir):
+        with open(os.path.join(dump_dir, filename), 'r') as f:
+            for line in f:
+                if all(r.search(line) for r in regexps):
+                    res += 1
+    return res
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the search index')
+    parser.add_argument('--messages', type=int, default=300000)
+    parser.add_argument('--dialogs', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=50,
+                        help='like search --limit (default: %(default)s)')
+    args = parser.parse_args()
+
+    raw_messages = make_archive(args.dialogs, args.messages, groupchats=10)
+    users_ids = set(m['user_id'] for m in raw_messages)
+    users_dict = make_users_dict(users_ids)
+    queries = [
+        ('one word', ['word341'], {}),
+        ('two words', ['word341', 'word249'], {}),
+        ('forwarded', ['forwarded'], {}),
+        ('in a dialog', ['word341'], {'dialog': 'userchat_1050'}),
+        ('by author', ['word341'], {'user_id': 1050, 'out': False}),
+        ('date range', ['word341'], {'since': raw_messages[1000]['date'],
+                                     'until': raw_messages[2000]['date']}),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        storage_dir = os.path.join(tmp_dir, 'storage')
+        dump_dir = os.path.join(tmp_dir, 'chatlogs')
+        storage = vk_messages_storage(storage_dir, dump_dir)
+        storage.search_index.is_disabled = True
+        save_time, _ = timed(lambda: (
+            storage.add_messages(vk_message(m) for m in raw_messages),
+            storage.save()))
+        storage.dump(users_dict)
+        storage.close()
+
+        storage = vk_messages_storage(storage_dir, dump_dir)
+        build_time, _ = timed(storage.load)
+        size = os.path.getsize(os.path.join(storage_dir,
+                                            vk_search_index.db_filename))
+
+        print('messages: %d in %d dialogs' % (args.messages, args.dialogs))
+        print('save without the index: %.2f s' % save_time)
+        print('index build: %.2f s, %.1f MiB' % (build_time, size / 2**20))
+        for title, words, filters in queries:
+            query_time, rows = timed(lambda: storage.search_index.search(
+                ' '.join(words), limit=args.limit, **filters))
+            line = '%s: %d found in %.1f ms' % (title, len(rows),
+                                                query_time * 1000)
+            if len(filters) == 0:
+                grep_time, _ = timed(lambda: grep_chatlogs(dump_dir, words))
+                line += ', chatlogs scan %.0f ms' % (grep_time * 1000)
+            print(line)
+        storage.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
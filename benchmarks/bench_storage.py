@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Compare storage formats: save / load times and size on disk.
+
+import os
+import sys
+import time
+import tempfile
+from argparse import ArgumentParser
+
+from synthetic import make_archive
+from vk_messages_backup import vk_message, vk_messages_storage, \
+    jsonl_storage_backend, print_json, storage_backends
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, filename))
+               for filename in os.listdir(path))
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+# the layout before jsonl: one pretty-printed json array per dialog
+def save_legacy(storage_dir, raw_messages):
+    dialogs = dict()
+    for raw_msg in raw_messages:
+        dialog_id = vk_message(raw_msg).dialog_id()
+        dialogs.setdefault(dialog_id, []).append(raw_msg)
+    os.mkdir(storage_dir)
+    for dialog_id, messages in dialogs.items():
+        filename = jsonl_storage_backend.filename(dialog_id, legacy=True)
+        with open(os.path.join(storage_dir, filename), 'w') as f:
+            print_json(messages, file=f)
+
+
+# the search index is measured by bench_search.py
+def open_storage(storage_dir, storage_format):
+    storage = vk_messages_storage(storage_dir, storage_dir, storage_format)
+    storage.search_index.is_disabled = True
+    return storage
+
+
+def bench_format(storage_format, storage_dir, raw_messages, new_messages):
+    res = dict()
+    if storage_format == 'legacy json':
+        res['save'] = timed(lambda: save_legacy(storage_dir, raw_messages))
+        res['size'] = dir_size(storage_dir)
+        storage_format = 'jsonl'
+    else:
+        def save():
+            storage = open_storage(storage_dir, storage_format)
+            storage.add_messages(vk_message(m) for m in raw_messages)
+            storage.save()
+            storage.close()
+        res['save'] = timed(save)
+        res['size'] = dir_size(storage_dir)
+
+    storage = open_storage(storage_dir, storage_format)
+    res['load'] = timed(storage.load)
+    res['read all'] = timed(lambda: [d.get_messages()
+                                     for d in storage.dialogs.values()])
+    storage.close()
+
+    def save_new():
+        storage = open_storage(storage_dir, storage_format)
+        storage.load()
+        storage.add_messages(vk_message(m) for m in new_messages)
+        storage.save()
+        storage.close()
+    res['incremental save'] = timed(save_new)
+    return res
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark storage formats')
+    parser.add_argument('--dialogs', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--groupchats', type=int, default=50)
+    args = parser.parse_args()
+
+    archive = make_archive(args.dialogs, args.messages, args.groupchats)
+    # 1% of messages come with the incremental update
+    split = len(archive) - len(archive) // 100
+    formats = ['legacy json'] + sorted(storage_backends.keys())
+    print('%-12s %8s %8s %9s %9s %10s' % (
+        'format', 'size,MiB', 'save,s', 'load,s', 'read,s', 'update,s'))
+    for storage_format in formats:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            storage_dir = os.path.join(tmp_dir, 'storage')
+            res = bench_format(storage_format, storage_dir, archive[:split],
+                               archive[split:])
+        print('%-12s %8.1f %8.2f %9.3f %9.2f %10.3f' % (
+            storage_format, res['size'] / 2**20, res['save'], res['load'],
+            res['read all'], res['incremental save']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
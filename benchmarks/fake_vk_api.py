@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+# Local stand-in for https://api.vk.com/method
+# ============================================
+#
+# Implements just enough of VK API 5.37 for vk_messages_backup.py:
+# 'messages.get' (out, offset, count, last_message_id), 'users.get',
+# 'execute' with the scripts generated by vk_api.execute() and
+# 'messages.getLongPollServer' with a long poll server under long_poll_url
+# that reports every added message (unless 'long_poll' is False). When
+# 'requests_per_second' is set, more frequent requests of one token get
+# the 'Too many requests per second' error like in real API. 'latency'
+# delays every response to imitate network round-trips. Attached files are
+# served under files_url with synthetic.file_content(), the ones in
+# 'broken_files' fail with HTTP 500. API requests fail with faults (see
+# 'faults' below) queued by inject() or chosen at random with 'fault_rate'.
+
+import sys
+import json
+import time
+import random
+import threading
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from argparse import ArgumentParser
+
+from synthetic import make_archive, make_raw_user, file_content
+
+
+class api_error(Exception):
+    def __init__(self, code, msg):
+        super().__init__(msg)
+        self.code = code
+        self.msg = msg
+
+
+class fake_vk_api:
+    # fault -> (HTTP status, VK API error code); a connection closed
+    # without a response for 'disconnect', in the middle of the body for
+    # 'truncated'
+    faults = {
+        'too_many_requests': (200, 6),
+        'flood_control': (200, 9),
+        'internal_error': (200, 10),
+        'captcha': (200, 14),
+        'auth': (200, 5),
+        'http_500': (500, None),
+        'http_502': (502, None),
+        'http_429': (429, None),
+        'disconnect': (None, None),
+        'truncated': (200, None),
+    }
+    # faults chosen with 'fault_rate': the ones a client can retry
+    transient_faults = ['too_many_requests', 'flood_control',
+                        'internal_error', 'http_500', 'http_502',
+                        'http_429', 'disconnect', 'truncated']
+
+    def __init__(self, messages=(), requests_per_second=None, latency=0,
+                 host='127.0.0.1', port=0, fault_rate=0, seed=0,
+                 long_poll=True):
+        self.messages = list(messages)
+        self.long_poll = long_poll
+        # new message events of the long poll, the ts of one is its index
+        self.events = []
+        self.long_poll_key = 'fake_key'
+        self.events_added = threading.Condition(threading.Lock())
+        self.requests_per_second = requests_per_second
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.random = random.Random(seed)
+        # faults of the next API requests
+        self.injected = deque()
+        # fault -> times it happened
+        self.fault_stats = defaultdict(int)
+        self.lock = threading.Lock()
+        # token -> times of recent requests
+        self.recent = defaultdict(deque)
+        # method -> calls count ('execute' counts inner calls too)
+        self.stats = defaultdict(int)
+        self.http_requests = 0
+        # names of files that cannot be downloaded
+        self.broken_files = set()
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d/method' % (host, port)
+
+    # the port is bound in the constructor, so messages with attachments can
+    # be generated before start()
+    @property
+    def long_poll_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d/longpoll' % (host, port)
+
+    @property
+    def files_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d/files' % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # fail the next 'count' API requests with 'fault'
+    def inject(self, fault, count=1):
+        if fault not in self.faults:
+            raise NameError('fake_vk_api.inject: unknown fault: %s' % fault)
+        with self.lock:
+            self.injected.extend([fault] * count)
+
+    # for internal use
+    def next_fault(self):
+        with self.lock:
+            if self.injected:
+                fault = self.injected.popleft()
+            elif self.fault_rate > 0 and \
+                    self.random.random() < self.fault_rate:
+                fault = self.random.choice(self.transient_faults)
+            else:
+                return None
+            self.fault_stats[fault] += 1
+            return fault
+
+    def add_messages(self, messages):
+        messages = list(messages)
+        with self.lock:
+            self.messages.extend(messages)
+        with self.events_added:
+            for msg in messages:
+                flags = 2 if msg['out'] else 0
+                peer_id = msg.get('chat_id', msg['user_id'])
+                self.events.append([4, msg['id'], flags, peer_id,
+                                    msg['date'], msg['body']])
+            self.events_added.notify_all()
+
+    # the next long poll requests get {'failed': 2}, a new key is needed
+    def expire_long_poll_key(self):
+        with self.events_added:
+            self.long_poll_key += '_'
+
+    # config.json contents for vk_api pointing to this server
+    def config(self, **kwargs):
+        res = {
+            'access_token': 'fake_token',
+            'user_id': 1,
+            'api_url': self.url,
+        }
+        res.update(kwargs)
+        return res
+
+    # for internal use
+    def handler_class(self):
+        api = self
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.startswith('/files/'):
+                    self.send_file(url.path[len('/files/'):])
+                    return
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                if url.path == '/longpoll':
+                    status, body = 200, api.long_poll_check(params)
+                else:
+                    method = url.path.rsplit('/', 1)[-1]
+                    status, body = api.handle(method, params)
+                if status is None:
+                    self.close_connection = True
+                    return
+                data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                size = len(data)
+                if body == {'fault': 'truncated'}:
+                    size *= 2
+                    self.close_connection = True
+                self.send_response(status)
+                self.send_header('Content-Type',
+                                 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_file(self, name):
+                with api.lock:
+                    api.http_requests += 1
+                    api.stats['files'] += 1
+                if name in api.broken_files:
+                    status, data = 500, b'broken'
+                else:
+                    status, data = 200, file_content(name)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return handler
+
+    # return (http status, json body), (None, None) to close the connection
+    def handle(self, method, params):
+        with self.lock:
+            self.http_requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        fault = self.next_fault()
+        try:
+            if fault is not None:
+                status, code = self.faults[fault]
+                if code is None:
+                    return status, {'fault': fault}
+                raise api_error(code, fault)
+            self.check_rate(params.get('access_token'))
+            return 200, {'response': self.call(method, params)}
+        except api_error as e:
+            return 200, {'error': {
+                'error_code': e.code,
+                'error_msg': e.msg,
+                'request_params': [{'key': 'method', 'value': method}],
+            }}
+
+    # for internal use
+    def check_rate(self, token):
+        if self.requests_per_second is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            recent = self.recent[token]
+            while recent and now - recent[0] >= 1.0:
+                recent.popleft()
+            if len(recent) >= self.requests_per_second:
+                raise api_error(6, 'Too many requests per second')
+            recent.append(now)
+
+    # for internal use
+    def call(self, method, params):
+        with self.lock:
+            self.stats[method] += 1
+        if method == 'messages.get':
+            return self.messages_get(params)
+        if method == 'users.get':
+            return self.users_get(params)
+        if method == 'execute':
+            return self.execute(params)
+        if method == 'messages.getLongPollServer' and self.long_poll:
+            with self.events_added:
+                return {'key': self.long_poll_key,
+                        'server': self.long_poll_url,
+                        'ts': len(self.events)}
+        raise api_error(3, 'Unknown method passed')
+
+    # for internal use
+    def messages_get(self, params):
+        out = int(params.get('out', 0))
+        offset = int(params.get('offset', 0))
+        count = min(int(params.get('count', 20)), 200)
+        last_message_id = int(params.get('last_message_id', 0))
+        with self.lock:
+            items = [msg for msg in self.messages
+                     if msg['out'] == out and msg['id'] > last_message_id]
+        # the newest messages first
+        items.sort(key=lambda msg: msg['id'], reverse=True)
+        return {'count': len(items), 'items': items[offset:offset+count]}
+
+    # for internal use
+    def users_get(self, params):
+        users_ids = [int(x) for x in params['user_ids'].split(',') if x]
+        return [make_raw_user(user_id) for user_id in users_ids]
+
+    # for internal use; wait up to 'wait' seconds for events after 'ts'
+    def long_poll_check(self, params):
+        with self.lock:
+            self.http_requests += 1
+            self.stats['long_poll'] += 1
+        ts = int(params['ts'])
+        deadline = time.monotonic() + int(params.get('wait', 25))
+        with self.events_added:
+            if params.get('key') != self.long_poll_key:
+                return {'failed': 2}
+            if ts > len(self.events):
+                return {'failed': 1, 'ts': len(self.events)}
+            while len(self.events) == ts:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self.events_added.wait(timeout)
+            return {'ts': len(self.events), 'updates': self.events[ts:]}
+
+    # for internal use
+    def execute(self, params):
+        decoder = json.JSONDecoder()
+        code = params['code']
+        res = []
+        pos = code.find('API.')
+        while pos != -1:
+            paren = code.index('(', pos)
+            method = code[pos+len('API.'):paren]
+            call_params, end = decoder.raw_decode(code, paren + 1)
+            call_params = {k: str(v) for k, v in call_params.items()}
+            try:
+                res.append(self.call(method, call_params))
+            except api_error:
+                res.append(False)
+            pos = code.find('API.', end)
+        return res
+
+
+def main():
+    parser = ArgumentParser(description='Local fake VK API server')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--dialogs', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--groupchats', type=int, default=2)
+    parser.add_argument('--requests-per-second', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--attachments', action='store_true',
+                        help='attach files served by this server')
+    parser.add_argument('--fault-rate', type=float, default=0,
+                        help='part of API requests that fail with a '
+                             'retriable error (default: %(default)s)')
+    args = parser.parse_args()
+
+    api = fake_vk_api(requests_per_second=args.requests_per_second,
+                      latency=args.latency, port=args.port,
+                      fault_rate=args.fault_rate)
+    files_url = api.files_url if args.attachments else None
+    api.add_messages(make_archive(args.dialogs, args.messages,
+                                  args.groupchats, files_url=files_url))
+    print('config.json for vk_messages_backup.py:')
+    print(json.dumps(api.config(), indent=4))
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+# Scripted backup scenarios against the fake VK API
+# =================================================
+#
+# Times a full backfill into an empty storage and an incremental update
+# (both are backup() runs, like ./vk_messages_backup.py), then
+# storage.load(), storage.save() of the whole archive into an empty storage
+# and a full dump() of all chatlogs. Results are printed and can be written
+# as a baseline (--save-baseline) or compared with one (--baseline): the
+# run fails if a scenario is slower than the baseline by more than
+# --tolerance. A baseline is only comparable on the same machine and with
+# the same archive parameters.
+
+import os
+import sys
+import json
+import time
+import logging
+import tempfile
+from argparse import ArgumentParser
+
+from fake_vk_api import fake_vk_api
+from synthetic import make_archive, my_id
+import vk_messages_backup
+from vk_messages_backup import vk_message, vk_messages_storage, \
+    vk_users_storage, run_metrics, create_argparser, create_timezone, \
+    print_json, backup
+
+
+scenarios = ['backfill', 'incremental', 'load', 'save', 'dump']
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+# one ./vk_messages_backup.py run; returns (seconds, stage seconds)
+def run_backup(config_file, storage_dir, chatlogs_dir, storage_format,
+               attachments):
+    argv = ['--config', config_file, '--storage', storage_dir,
+            '--chatlogs', chatlogs_dir]
+    if storage_format is not None:
+        argv += ['--storage-format', storage_format]
+    if attachments:
+        argv.append('--attachments')
+    args = create_argparser().parse_args(argv)
+    vk = vk_messages_backup.vk_api(args.config)
+    vk.metrics = run_metrics()
+    tz = create_timezone(vk.timezone)
+    elapsed = timed(lambda: backup(args, vk, tz))
+    return elapsed, vk.metrics.report()['stage_seconds']
+
+
+def stored_messages_count(storage_dir, storage_format):
+    storage = vk_messages_storage(storage_dir, storage_dir, storage_format)
+    storage.load()
+    res = sum(dialog.count for dialog in storage.dialogs.values())
+    storage.close()
+    return res
+
+
+def run_scenarios(args, tmp_dir):
+    api = fake_vk_api(requests_per_second=args.server_requests_per_second,
+                      latency=args.latency).start()
+    files_url = api.files_url if args.attachments > 0 else None
+    archive = make_archive(args.dialogs, args.messages, args.groupchats,
+                           seed=args.seed, files_url=files_url,
+                           forward_depth=args.forward_depth,
+                           actions=args.actions, attachments=args.attachments)
+    # the newest messages come with the incremental update
+    split = len(archive) - int(len(archive) * args.new_messages)
+    config_file = os.path.join(tmp_dir, 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump(api.config(requests_per_second=args.requests_per_second,
+                             use_execute=args.use_execute), f)
+    storage_dir = os.path.join(tmp_dir, 'storage')
+    chatlogs_dir = os.path.join(tmp_dir, 'chatlogs')
+    res = {'seconds': dict(), 'stages': dict()}
+
+    try:
+        for name, messages in (('backfill', archive[:split]),
+                               ('incremental', archive[split:])):
+            api.add_messages(messages)
+            requests_before = api.http_requests
+            elapsed, stages = run_backup(config_file, storage_dir,
+                                         chatlogs_dir, args.storage_format,
+                                         args.attachments > 0)
+            res['seconds'][name] = elapsed
+            res['stages'][name] = stages
+            res.setdefault('requests', dict())[name] = \
+                api.http_requests - requests_before
+    finally:
+        api.stop()
+
+    # everything is downloaded exactly once
+    count = stored_messages_count(storage_dir, args.storage_format)
+    if count != len(archive):
+        raise NameError('run_scenarios: %d messages stored instead of %d' %
+                        (count, len(archive)))
+
+    storage = vk_messages_storage(storage_dir, chatlogs_dir,
+                                  args.storage_format)
+    res['seconds']['load'] = timed(storage.load)
+    storage.close()
+
+    save_dir = os.path.join(tmp_dir, 'storage_save')
+    storage = vk_messages_storage(save_dir, save_dir, args.storage_format)
+    messages = [vk_message(raw_msg) for raw_msg in archive]
+
+    def save():
+        storage.add_messages(messages)
+        storage.save()
+    res['seconds']['save'] = timed(save)
+    storage.close()
+
+    # chatlogs of another directory are not known, so all of them are
+    # rendered again
+    users_storage = vk_users_storage(storage_dir)
+    users_storage.load()
+    storage = vk_messages_storage(storage_dir,
+                                  os.path.join(tmp_dir, 'chatlogs_dump'),
+                                  args.storage_format)
+    storage.load()
+    users_dict = users_storage.users_dict(my_id)
+    res['seconds']['dump'] = timed(
+        lambda: storage.dump(users_dict, args.jobs))
+    storage.close()
+    return res
+
+
+# parameters of a run that must match the baseline
+def archive_params(args):
+    return {name: getattr(args, name) for name in (
+        'dialogs', 'messages', 'groupchats', 'forward_depth', 'actions',
+        'attachments', 'new_messages', 'seed', 'storage_format', 'jobs',
+        'latency', 'requests_per_second', 'server_requests_per_second',
+        'use_execute')}
+
+
+# print the results next to the baseline; return names of scenarios that
+# are slower than the baseline by more than 'tolerance'
+def compare(res, baseline, tolerance):
+    slower = []
+    print('%-12s %10s %10s %8s' % ('scenario', 'time,s', 'baseline,s',
+                                   'ratio'))
+    for name in scenarios:
+        seconds = res['seconds'][name]
+        base = baseline['seconds'].get(name)
+        if base is None:
+            print('%-12s %10.3f %10s %8s' % (name, seconds, '-', '-'))
+            continue
+        ratio = seconds / base if base > 0 else float('inf')
+        mark = ''
+        if ratio > 1 + tolerance:
+            slower.append(name)
+            mark = ' slower'
+        print('%-12s %10.3f %10.3f %8.2f%s' % (name, seconds, base, ratio,
+                                                mark))
+    return slower
+
+
+def main():
+    parser = ArgumentParser(
+        description='Time backup scenarios against the fake VK API')
+    parser.add_argument('--dialogs', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--groupchats', type=int, default=10)
+    parser.add_argument('--forward-depth', type=int, default=1,
+                        help='levels of nested forwarded messages')
+    parser.add_argument('--actions', type=float, default=0.02,
+                        help='part of groupchat messages that are service '
+                             'messages (default: %(default)s)')
+    parser.add_argument('--attachments', type=float, default=0,
+                        help='part of messages with attached files, they '
+                             'are downloaded by backfill and incremental '
+                             'runs (default: %(default)s)')
+    parser.add_argument('--new-messages', type=float, default=0.01,
+                        help='part of messages that come with the '
+                             'incremental update (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--storage-format', default=None,
+                        choices=['jsonl', 'sqlite'])
+    parser.add_argument('--jobs', '-j', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds per request of the fake API')
+    parser.add_argument('--requests-per-second', type=float, default=1000,
+                        help='client rate limit (default: %(default)s)')
+    parser.add_argument('--server-requests-per-second', type=int,
+                        default=None,
+                        help='answer more frequent requests with the '
+                             '"Too many requests" error')
+    parser.add_argument('--use-execute', action='store_true')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='run all scenarios that many times and take '
+                             'the best time of each (default: %(default)s)')
+    parser.add_argument('--baseline', default=None, metavar='FILE',
+                        help='compare with results saved in FILE')
+    parser.add_argument('--save-baseline', default=None, metavar='FILE',
+                        help='save results to FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    params = archive_params(args)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['params'] != params:
+            raise NameError('main: baseline %s was taken with other '
+                            'parameters: %s' % (args.baseline,
+                                                baseline['params']))
+
+    res = None
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run_res = run_scenarios(args, tmp_dir)
+        if res is None:
+            res = run_res
+            continue
+        for name, seconds in run_res['seconds'].items():
+            if seconds < res['seconds'][name]:
+                res['seconds'][name] = seconds
+                res['stages'][name] = run_res['stages'].get(name)
+    res['params'] = params
+
+    for name in ('backfill', 'incremental'):
+        print('%s: %d HTTP requests, stages: %s' % (
+            name, res['requests'][name],
+            ', '.join('%s %.3fs' % item
+                      for item in res['stages'][name].items())))
+    slower = []
+    if baseline is not None:
+        slower = compare(res, baseline, args.tolerance)
+    else:
+        for name in scenarios:
+            print('%-12s %10.3f s' % (name, res['seconds'][name]))
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            print_json(res, file=f)
+    if len(slower) > 0:
+        print('slower than the baseline: %s' % ', '.join(slower))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+# Synthetic messages and users for benchmarks
+# ===========================================
+
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vk_messages_backup import vk_message, vk_user  # noqa: E402
+
+
+my_id = 1
+start_date = 1262304000  # 2010-01-01
+
+
+def make_raw_user(user_id):
+    return {
+        'id': user_id,
+        'first_name': 'First%d' % user_id,
+        'last_name': 'Last%d' % user_id,
+    }
+
+
+def make_users_dict(users_ids):
+    res = dict()
+    for user_id in set(users_ids) | {my_id}:
+        res[user_id] = vk_user(make_raw_user(user_id))
+    res['me'] = res[my_id]
+    return res
+
+
+# contents of a file served by fake_vk_api under 'name'
+def file_content(name):
+    rnd = random.Random(name)
+    return rnd.randbytes(rnd.randint(1000, 100000))
+
+
+# a photo, a document or an audio with a file under 'files_url'; files are
+# taken from a small pool, so the same file is attached to several messages
+# and several attachments have the same contents
+def make_raw_attachment(rnd, files_url):
+    kind = rnd.choice(['photo', 'doc', 'audio'])
+    attachment_id = rnd.randint(1, 10000)
+    url = '%s/file%d' % (files_url, attachment_id % 500)
+    data = {'id': attachment_id, 'owner_id': rnd.randint(1, 100)}
+    if kind == 'photo':
+        data['photo_130'] = url + '_small'
+        data['photo_604'] = url
+    elif kind == 'doc':
+        data['title'] = 'document%d.txt' % attachment_id
+        data['url'] = url
+    else:
+        data['artist'] = 'Artist'
+        data['title'] = 'Track %d' % attachment_id
+        data['url'] = url
+    return {'type': kind, kind: data}
+
+
+# actions of groupchat service messages that vk_message_formatter knows
+def make_action(rnd, chat_id):
+    kind = rnd.choice(['chat_create', 'chat_title_update',
+                       'chat_photo_update', 'chat_photo_remove',
+                       'chat_invite_user', 'chat_kick_user'])
+    res = {'action': kind}
+    if kind == 'chat_create':
+        res['action_text'] = 'Chat %d' % chat_id
+    elif kind == 'chat_title_update':
+        res['action_text'] = 'Chat %d, renamed' % chat_id
+    elif kind in ('chat_invite_user', 'chat_kick_user'):
+        if rnd.random() < 0.9:
+            res['action_mid'] = rnd.randint(2, 2 + 50)
+        else:
+            res['action_mid'] = -1
+            res['action_email'] = 'someone@example.com'
+    return res
+
+
+# a forwarded message with 'depth' levels of forwarded messages in it
+def make_forward(rnd, date, user_id, depth):
+    res = {
+        'date': date - rnd.randint(1, 100000),
+        'user_id': user_id,
+        'body': 'forwarded\nmultiline',
+    }
+    if depth > 1:
+        res['fwd_messages'] = [make_forward(rnd, res['date'], user_id,
+                                            depth - 1)]
+    return res
+
+
+# 'chat_id' is None for a userchat with 'user_id'; with 'files_url' that
+# part of messages ('attachments') gets attachments; forwarded messages
+# are nested up to 'forward_depth' levels; that part of groupchat messages
+# ('actions') are service messages like 'user invited'
+def make_raw_message(rnd, msg_id, date, user_id, chat_id=None,
+                     files_url=None, forward_depth=1, actions=0,
+                     attachments=0.1):
+    msg = {
+        'id': msg_id,
+        'date': date,
+        'out': int(rnd.random() < 0.5),
+        'user_id': user_id,
+        'read_state': 1,
+        'title': ' ... ',
+        'body': ' '.join('word%d' % rnd.randint(0, 999)
+                         for _ in range(rnd.randint(1, 30))),
+    }
+    if chat_id is not None:
+        msg['chat_id'] = chat_id
+        msg['title'] = 'Chat %d' % chat_id
+        # authors of groupchat messages, including own ones
+        if msg['out']:
+            msg['user_id'] = my_id
+    if rnd.random() < 0.05:
+        msg['fwd_messages'] = [make_forward(rnd, date, user_id,
+                                            forward_depth)]
+    if files_url is not None and rnd.random() < attachments:
+        files = [make_raw_attachment(rnd, files_url)
+                 for _ in range(rnd.randint(1, 3))]
+        # some of them in a forwarded message
+        if 'fwd_messages' in msg and rnd.random() < 0.5:
+            msg['fwd_messages'][0]['attachments'] = files
+        else:
+            msg['attachments'] = files
+    if chat_id is not None and actions > 0 and rnd.random() < actions:
+        msg.update(make_action(rnd, chat_id))
+        msg['out'] = 0
+        msg['user_id'] = rnd.randint(2, 2 + 50)
+    return msg
+
+
+# messages of one dialog in chronological order
+def make_dialog_messages(count, user_id, chat_id=None, first_id=1, seed=0):
+    rnd = random.Random(seed)
+    date = start_date
+    res = []
+    for i in range(count):
+        date += rnd.randint(0, 600)
+        raw = make_raw_message(rnd, first_id + i, date, user_id, chat_id)
+        res.append(vk_message(raw))
+    return res
+
+
+# raw messages of several dialogs ('groupchats' of them are groupchats),
+# ids grow with dates like in VK; see make_raw_message() for the rest
+def make_archive(dialogs, messages, groupchats=0, seed=0, files_url=None,
+                 forward_depth=1, actions=0, attachments=0.1):
+    rnd = random.Random(seed)
+    date = start_date
+    res = []
+    for msg_id in range(1, messages + 1):
+        date += rnd.randint(0, 60)
+        dialog = rnd.randrange(dialogs)
+        if dialog < groupchats:
+            chat_id = dialog + 1
+            user_id = rnd.randint(2, 2 + 50)
+        else:
+            chat_id = None
+            user_id = 1000 + dialog
+        res.append(make_raw_message(rnd, msg_id, date, user_id, chat_id,
+                                    files_url, forward_depth, actions,
+                                    attachments))
+    return res
@@ -13,11 +13,33 @@ import os
 import sys
 import json
 import time
-from datetime import tzinfo, timedelta, datetime
+import random
+import hashlib
+import gzip
+import html
+import tempfile
+import sqlite3
+import threading
+import queue
+import cProfile
+import signal
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import tzinfo, timedelta, datetime, date as date_cls
+from operator import attrgetter
 import re
 import logging
 import requests
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:
+    ZoneInfo = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 # General purpose utils
@@ -31,6 +53,26 @@ class TZ(tzinfo):
         return timedelta(0)
 
 
+# IANA timezone name (like 'Europe/Berlin') or None for TZ
+def create_timezone(name):
+    if name is None:
+        return TZ()
+    if ZoneInfo is None:
+        raise NameError('create_timezone: zoneinfo module is not available, '
+                        'cannot use timezone %s' % name)
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise NameError('create_timezone: unknown timezone: %s' % name)
+
+
+# None for TZ
+def timezone_name(tz):
+    if isinstance(tz, TZ):
+        return None
+    return getattr(tz, 'key', str(tz))
+
+
 def safe_mkdir(new_dir):
     if os.path.exists(new_dir):
         if not os.path.isdir(new_dir):
@@ -45,12 +87,109 @@ def print_json(json_dict, file=sys.stdout):
     print(file=file)
 
 
-def prettify_logging():
+# one JSON document per line, for append-only storage files
+def json_line(json_dict):
+    return json.dumps(json_dict, ensure_ascii=False, sort_keys=True) + '\n'
+
+
+json_decoder = json.JSONDecoder()
+
+
+# decode one utf-8 json_line() record; twice faster than json.loads() on
+# bytes, that guesses the encoding first
+def json_record(data):
+    return json_decoder.raw_decode(data.decode('utf-8'))[0]
+
+
+# make written data of the files durable; callers collect the files and
+# sync them together after all writes; a global sync() is not used, it
+# flushes every filesystem of the host
+def sync_files(filepaths):
+    for filepath in filepaths:
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# make created, renamed and removed directory entries durable
+def sync_dir(dirpath):
+    if os.name != 'posix':
+        return
+    fd = os.open(dirpath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Files are written next to their final paths and moved into place
+# together by commit(): all of them are synced at once, then renamed, then
+# every directory is synced once. A crash leaves either old or new
+# contents of every file, never a truncated one.
+class file_transaction:
+    tmp_suffix = '.tmp'
+
+    def __init__(self):
+        # (tmp_filepath, filepath) pairs to rename on commit()
+        self.renames = []
+        # files that are changed in place (appended to)
+        self.synced = set()
+
+    # a file that replaces 'filepath' on commit()
+    def open(self, filepath, mode='w', **kwargs):
+        tmp_filepath = filepath + self.tmp_suffix
+        f = open(tmp_filepath, mode, **kwargs)
+        self.add(tmp_filepath, filepath)
+        return f
+
+    # 'tmp_filepath' is written by someone else
+    def add(self, tmp_filepath, filepath):
+        self.renames.append((tmp_filepath, filepath))
+
+    def add_synced(self, filepath):
+        self.synced.add(filepath)
+
+    def commit(self):
+        sync_files([tmp_filepath for tmp_filepath, _ in self.renames] +
+                   sorted(self.synced))
+        dirpaths = set()
+        for tmp_filepath, filepath in self.renames:
+            os.replace(tmp_filepath, filepath)
+            dirpaths.add(os.path.dirname(os.path.abspath(filepath)))
+        # appended files may be just created
+        for filepath in self.synced:
+            dirpaths.add(os.path.dirname(os.path.abspath(filepath)))
+        for dirpath in sorted(dirpaths):
+            sync_dir(dirpath)
+        self.renames = []
+        self.synced = set()
+
+    # remove written temporary files
+    def abort(self):
+        for tmp_filepath, _ in self.renames:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+        self.renames = []
+        self.synced = set()
+
+
+bad_title_symbol_re = re.compile(r'[^a-zA-Z0-9А-ЯЁа-яё «»"\'()?.,:+-]')
+
+
+def sanitize_title(title):
+    return bad_title_symbol_re.sub('_', title).rstrip('.')
+
+
+def prettify_logging(thread_names=False):
     """ Setup logger format. """
     # TODO: colors when isatty()
     handler = logging.StreamHandler()
+    # accounts of a multi-account backup are told apart by thread names
+    thread_name = '[{threadName}] ' if thread_names else ''
     formatter = logging.Formatter(
-        '{asctime} {levelname:4s} {message}', style='{')
+        '{asctime} {levelname:4s} ' + thread_name + '{message}', style='{')
     handler.setFormatter(formatter)
     logging.getLogger().addHandler(handler)
 
@@ -87,340 +226,2232 @@ def create_argparser():
         description='Backup chatlogs from vk.com social network')
     parser.add_argument('--quiet', '-q', action='store_true')
     parser.add_argument('--config', default=None, help='specify a config file')
+    parser.add_argument(
+        '--account', default=None,
+        help='user_id or name of the account of a multi-account config to '
+             'use (default: back up all of them)')
     parser.add_argument(
         '--storage', default='./storage',
         help='path to messages storage (default: %(default)s)')
     parser.add_argument(
         '--chatlogs', default='./chatlogs',
         help='where to save formatted chatlogs (default: %(default)s)')
+    parser.add_argument(
+        '--storage-format', default=None, choices=['jsonl', 'sqlite'],
+        help='how to keep messages in the storage; existing json / jsonl '
+             'files are imported into a new sqlite database (default: '
+             'sqlite if the storage has a database, jsonl otherwise)')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help='render chatlogs in that many processes (default: %(default)s)')
+    parser.add_argument(
+        '--timezone', default=None,
+        help='IANA timezone of chatlog timestamps, like Europe/Berlin; '
+             'overrides "timezone" from the config (default: UTC+3)')
+    parser.add_argument(
+        '--attachments', action='store_true',
+        help='download attached photos, documents, audio and stickers to '
+             'the attachments directory of the storage')
+    parser.add_argument(
+        '--sequential', action='store_true',
+        help='download sent messages, received messages and users one '
+             'after another (the old behaviour)')
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='after the backup keep running: wait for new messages on the '
+             'VK long poll server and save and render them as they come')
+    parser.add_argument(
+        '--poll-interval', type=float, default=60,
+        help='seconds between checks for new messages when the long poll '
+             'is not available, and after its errors (default: '
+             '%(default)s)')
+    parser.add_argument(
+        '--metrics', default=None, metavar='FILE',
+        help='write timings of stages, API requests and sizes to FILE: '
+             'JSON or Prometheus textfile format if FILE ends with .prom')
+    parser.add_argument(
+        '--profile', default=None, metavar='FILE',
+        help='write cProfile stats of the run to FILE (other threads and '
+             'processes are not profiled), see python -m pstats')
+
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.add_parser(
+        'backup', help='download new messages and render chatlogs '
+                       '(the default)')
+    search_parser = subparsers.add_parser(
+        'search', help='find stored messages by words, newest first')
+    search_parser.add_argument('query', nargs='+')
+    search_parser.add_argument(
+        '--dialog', default=None,
+        help='userchat_<id>, groupchat_<id> or a chatlog title')
+    search_parser.add_argument(
+        '--author', default=None, help='user id or "me"')
+    search_parser.add_argument(
+        '--since', default=None, help='YYYY-MM-DD, first day to search')
+    search_parser.add_argument(
+        '--until', default=None, help='YYYY-MM-DD, last day to search')
+    search_parser.add_argument(
+        '--limit', type=int, default=50,
+        help='show at most that many messages (default: %(default)s)')
+    search_parser.add_argument(
+        '--fts', action='store_true',
+        help='the query is in SQLite FTS5 syntax (OR, NOT, prefix*, ...)')
+    export_parser = subparsers.add_parser(
+        'export', help='write stored dialogs as compressed chunks or HTML '
+                       'pages, only changed chunks are written again')
+    export_parser.add_argument(
+        '--output', default='./export',
+        help='export directory (default: %(default)s)')
+    export_parser.add_argument(
+        '--format', default='jsonl.gz', choices=sorted(vk_exporter.extensions),
+        help='raw messages as gzip or zstd (needs the zstandard module) '
+             'compressed JSON Lines, or chatlog pages (default: '
+             '%(default)s)')
+    export_parser.add_argument(
+        '--chunk-size', type=float, default=16,
+        help='MiB of uncompressed data per chunk (default: %(default)s)')
     return parser
 
 
 # Classes
 # =======
 
+# Counters and timers of a run for --metrics. Every value is keyed by a
+# metric name and a label value (a stage or an API method) if the metric
+# has a label; the report is JSON or a Prometheus textfile (by the file
+# extension). Safe to use from several threads.
+class run_metrics:
+    prefix = 'vk_backup_'
+    prometheus_suffix = '.prom'
+    # name -> (label name or None, help)
+    descriptions = {
+        'stage_seconds': ('stage', 'Wall time of a run stage'),
+        'api_requests_total': ('method', 'VK API requests'),
+        'api_request_seconds_total': (
+            'method', 'Time of VK API requests: network and server'),
+        'api_parse_seconds_total': (
+            'method', 'Time of parsing VK API responses'),
+        'api_response_bytes_total': ('method', 'Size of VK API responses'),
+        'api_errors_total': ('method', 'Failed VK API requests'),
+        'api_error_kinds_total': (
+            'error', 'Failed VK API requests by the error: a VK API error '
+                     'code, an HTTP status or a network failure'),
+        'api_retries_total': ('method', 'Repeated VK API requests'),
+        'rate_limit_slowdowns_total': (
+            None, 'Rate limit decreases after "too many requests" errors'),
+        'rate_limit_sleeps_total': (None, 'Waits for the rate limiter'),
+        'rate_limit_sleep_seconds_total': (
+            None, 'Time spent waiting for the rate limiter'),
+        'messages_added_total': (None, 'New messages added to the storage'),
+        'users_downloaded_total': (None, 'Users downloaded'),
+        'chatlogs_rendered_total': (None, 'Chatlogs rendered from scratch'),
+        'chatlogs_appended_total': (None, 'Chatlogs with appended messages'),
+        'attachments_downloaded_total': (None, 'Attached files downloaded'),
+        'attachments_failed_total': (None, 'Failed downloads of files'),
+        'attachments_bytes_total': (None, 'Size of downloaded files'),
+    }
+
+    # daemons of several accounts save reports to one file
+    save_lock = threading.Lock()
+
+    # 'account' names the metrics of an account of a multi-account backup,
+    # all metrics of a 'group' list are saved to one file
+    def __init__(self, account=None, group=None):
+        self.started_at = time.time()
+        self.account = account
+        self.group = [] if group is None else group
+        self.group.append(self)
+        # name -> {label value or None: value}
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def add(self, name, value=1, label=None):
+        if name not in self.descriptions:
+            raise NameError('run_metrics.add: unknown metric: %s' % name)
+        with self.lock:
+            values = self.values.setdefault(name, dict())
+            values[label] = values.get(label, 0) + value
+
+    # time the body of the 'with' statement
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add('stage_seconds', time.perf_counter() - start, name)
+
+    def report(self):
+        with self.lock:
+            res = {
+                'started_at': self.started_at,
+                'duration_seconds': time.time() - self.started_at,
+            }
+            for name, (label_name, _) in self.descriptions.items():
+                if name not in self.values:
+                    continue
+                if label_name is None:
+                    res[name] = self.values[name][None]
+                else:
+                    res[name] = dict(self.values[name])
+            return res
+
+    # for internal use
+    @staticmethod
+    def prometheus_labels(labels):
+        if len(labels) == 0:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (name,
+                         value.replace('\\', '\\\\').replace('"', '\\"'))
+            for name, value in labels)
+
+    # metrics of the group, told apart by the 'account' label
+    def prometheus(self):
+        lines = []
+        reports = [(m.account, m.report()) for m in self.group]
+        for name in ['duration_seconds'] + list(self.descriptions.keys()):
+            if all(name not in report for _, report in reports):
+                continue
+            label_name, help_text = self.descriptions.get(
+                name, (None, 'Wall time of the run'))
+            metric_type = 'counter' if name.endswith('_total') else 'gauge'
+            full_name = self.prefix + name
+            lines.append("# HELP %s %s" % (full_name, help_text))
+            lines.append('# TYPE %s %s' % (full_name, metric_type))
+            for account, report in reports:
+                if name not in report:
+                    continue
+                labels = [] if account is None else [('account', account)]
+                if label_name is None:
+                    lines.append('%s%s %r' % (
+                        full_name, self.prometheus_labels(labels),
+                        float(report[name])))
+                    continue
+                for label, value in sorted(report[name].items()):
+                    lines.append('%s%s %r' % (
+                        full_name,
+                        self.prometheus_labels(labels + [(label_name, label)]),
+                        float(value)))
+        return '\n'.join(lines) + '\n'
+
+    # write the report atomically, as the Prometheus textfile collector
+    # expects; reports of accounts go to the "accounts" object by names
+    def save(self, filepath):
+        with self.save_lock:
+            transaction = file_transaction()
+            with transaction.open(filepath, 'w', encoding='utf-8') as f:
+                if filepath.endswith(self.prometheus_suffix):
+                    f.write(self.prometheus())
+                elif self.account is None:
+                    print_json(self.report(), file=f)
+                else:
+                    print_json({'accounts': {
+                        m.account: m.report() for m in self.group}}, file=f)
+            transaction.commit()
+
+
+# metrics of the current run
+metrics = run_metrics()
+
+
+# token bucket: 'rate' requests per second on average, up to 'burst'
+# requests at once after an idle period; slow_down() and recover() adapt
+# the rate to the server between 'min_rate' and the configured one
+class rate_limiter:
+    min_rate = 0.2
+    slow_down_factor = 0.5
+    # part of the configured rate regained with every successful request
+    recover_step = 0.05
+
+    def __init__(self, rate, burst=1):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    # for internal use
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+    # block until a request is allowed, return the waiting time
+    def acquire(self):
+        slept = 0
+        with self.lock:
+            self.refill()
+            while self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                time.sleep(delay)
+                slept += delay
+                self.refill()
+            self.tokens -= 1
+        return slept
+
+    # the server says that requests are too frequent
+    def slow_down(self):
+        with self.lock:
+            self.refill()
+            self.rate = max(min(self.min_rate, self.max_rate),
+                            self.rate * self.slow_down_factor)
+            self.tokens = min(self.tokens, 0)
+
+    # a request succeeded
+    def recover(self):
+        if self.rate >= self.max_rate:
+            return
+        with self.lock:
+            self.refill()
+            self.rate = min(self.max_rate,
+                            self.rate + self.max_rate * self.recover_step)
+
+
+# A failed VK API request. 'kind' is how vk_api.do_request() handles it:
+# 'rate_limit' and 'transient' errors are retried, 'fatal' are not. 'code'
+# is the VK API error code, 'http_<status>' or 'network'; 'response' is the
+# VK API error response if any.
+class vk_api_error(NameError):
+    def __init__(self, kind, code, msg, response=None):
+        super().__init__('vk_api: %s error %s: %s' % (kind, code, msg))
+        self.kind = kind
+        self.code = code
+        self.response = response
+
+
 class vk_api:
-    def __init__(self, config_file=None):
+    default_base_url = 'https://api.vk.com/method'
+    default_requests_per_second = 1 / 0.35
+    # HTTP connections kept for concurrent requests
+    pool_size = 8
+    # VK API limit of API calls inside one 'execute'
+    max_execute_calls = 25
+    default_users_batch_size = 500
+    default_users_ttl_days = 30
+    default_users_refresh_limit = 1000
+    default_attachments_threads = 4
+    default_max_retries = 5
+    default_request_timeout = 60
+    # seconds before the first retry, doubled with every next one
+    retry_base_delay = 1.0
+    retry_max_delay = 60.0
+    # VK API error codes: too many requests per second, flood control
+    rate_limit_errors = {6, 9}
+    # unknown error, internal server error
+    transient_errors = {1, 10}
+    # others, like authorization failed (5) or captcha needed (14), are
+    # not retried
+
+    # 'account' is an entry of "accounts" of a multi-account config, its
+    # settings override the common ones; 'session' is a requests.Session
+    # to share connections with other vk_api objects
+    def __init__(self, config_file=None, account=None, session=None):
         self.config_file = find_config(config_file)
-        self.read_config()
-        self.base_url = 'https://api.vk.com/method'
+        self.read_config(account)
         self.vk_api_version = '5.37'
-        self.time_between_requests = 0.35
-        self.last_req_time = 0
+        self.limiter = rate_limiter(self.requests_per_second, self.burst)
         self.common_params = {
             'access_token': self.access_token,
             'v': self.vk_api_version,
         }
-        self.session = requests.Session()
+        if session is None:
+            session = self.create_session(
+                max(self.pool_size, self.attachments_threads))
+        # attached files are downloaded through it too
+        self.session = session
+        # vk_users_cache shared with other accounts, see get_vk_users()
+        self.users_cache = None
+        # run_metrics of the account, see backup_accounts()
+        self.metrics = metrics
+
+    @staticmethod
+    def create_session(pool_size):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
 
     # for internal use
-    def read_config(self):
-        if not os.path.isfile(self.config_file):
+    def read_config(self, account=None):
+        if self.config_file is None or not os.path.isfile(self.config_file):
             raise NameError('vk_api.__init__: cannot read config file: %s' %
                             self.config_file)
         with open(self.config_file, 'r') as f:
             config_data = json.load(f)
+        if account is not None:
+            config_data = dict(config_data, **account)
+        elif 'accounts' in config_data:
+            raise NameError('vk_api.__init__: %s lists several accounts, '
+                            'choose one with --account' % self.config_file)
         self.access_token = config_data['access_token']
         self.user_id = config_data['user_id']
-
-    # specific method parameters will overwrite corresponding common parameters
+        # optional parameters
+        self.base_url = config_data.get('api_url', self.default_base_url)
+        self.requests_per_second = config_data.get(
+            'requests_per_second', self.default_requests_per_second)
+        self.burst = config_data.get('burst', 1)
+        self.use_execute = config_data.get('use_execute', False)
+        # ids per users.get request
+        self.users_batch_size = config_data.get(
+            'users_batch_size', self.default_users_batch_size)
+        # users downloaded earlier are refreshed (not more than the limit
+        # per run) to catch renames
+        self.users_ttl = 24 * 60 * 60 * config_data.get(
+            'users_ttl_days', self.default_users_ttl_days)
+        self.users_refresh_limit = config_data.get(
+            'users_refresh_limit', self.default_users_refresh_limit)
+        # chatlogs timezone, see create_timezone()
+        self.timezone = config_data.get('timezone')
+        # attached files downloaded at once, see download_attachments()
+        self.attachments_threads = config_data.get(
+            'attachments_threads', self.default_attachments_threads)
+        # retries of a failed request, see do_request()
+        self.max_retries = config_data.get(
+            'max_retries', self.default_max_retries)
+        self.request_timeout = config_data.get(
+            'request_timeout', self.default_request_timeout)
+
+    # specific method parameters will overwrite corresponding common
+    # parameters; rate limit errors slow the limiter down, they and
+    # transient errors are retried after a growing pause with jitter,
+    # vk_api_error is raised when retries are over or for a fatal error
     def do_request(self, method, params):
+        attempt = 0
+        while True:
+            try:
+                response = self.try_request(method, params)
+            except vk_api_error as e:
+                self.metrics.add('api_errors_total', 1, method)
+                self.metrics.add('api_error_kinds_total', 1, str(e.code))
+                if e.kind == 'rate_limit':
+                    self.limiter.slow_down()
+                    self.metrics.add('rate_limit_slowdowns_total')
+                if e.kind == 'fatal' or attempt >= self.max_retries:
+                    if e.response is not None:
+                        print('VK API response with error, see dump below',
+                              file=sys.stderr)
+                        print_json(e.response, file=sys.stderr)
+                    raise
+                delay = self.retry_delay(attempt)
+                attempt += 1
+                self.metrics.add('api_retries_total', 1, method)
+                logging.warning('%s, retry %d of %d in %.1fs', e, attempt,
+                                self.max_retries, delay)
+                time.sleep(delay)
+                continue
+            self.limiter.recover()
+            return response
+
+    # for internal use; full jitter: a random pause up to the exponential
+    # backoff, so concurrent requests do not retry at once
+    def retry_delay(self, attempt):
+        return random.uniform(0, min(self.retry_max_delay,
+                                     self.retry_base_delay * 2 ** attempt))
+
+    # for internal use; one attempt of do_request()
+    def try_request(self, method, params):
         # don't do requests too often
-        time_since_prev_req = int(time.time()) - self.last_req_time
-        time_to_wait = self.time_between_requests - time_since_prev_req
-        if time_to_wait > 0:
-            time.sleep(time_to_wait)
+        slept = self.limiter.acquire()
+        if slept > 0:
+            self.metrics.add('rate_limit_sleeps_total')
+            self.metrics.add('rate_limit_sleep_seconds_total', slept)
 
         # do http request
         request_url = self.base_url.rstrip('/') + '/' + method
         req_params = self.common_params.copy()
         req_params.update(params)
-        r = self.session.get(request_url, params=req_params)
-        self.last_req_time = int(time.time())
+        start = time.perf_counter()
+        try:
+            r = self.session.get(request_url, params=req_params,
+                                 timeout=self.request_timeout)
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.ContentDecodingError) as e:
+            # the last two are a body cut off in the middle of the transfer
+            raise vk_api_error('transient', 'network', e)
+        parse_start = time.perf_counter()
+        self.metrics.add('api_requests_total', 1, method)
+        self.metrics.add('api_request_seconds_total', parse_start - start,
+                         method)
+        if r.status_code == 429:
+            raise vk_api_error('rate_limit', 'http_429', r.reason)
+        if r.status_code >= 500:
+            raise vk_api_error('transient', 'http_%d' % r.status_code,
+                               r.reason)
+        if r.status_code != 200:
+            raise vk_api_error('fatal', 'http_%d' % r.status_code, r.reason)
 
         # extract response
         r.encoding = 'utf-8'
-        general_response = r.json()
+        try:
+            general_response = r.json()
+        except ValueError as e:
+            # a truncated response
+            raise vk_api_error('transient', 'bad_json', e)
+        self.metrics.add('api_parse_seconds_total',
+                         time.perf_counter() - parse_start, method)
+        self.metrics.add('api_response_bytes_total', len(r.content), method)
         if 'error' in general_response:
-            print('VK API response with error, see dump below',
-                  file=sys.stderr)
-            print_json(general_response, file=sys.stderr)
-            return NameError('vk_api.do_request: error response')
+            error = general_response['error']
+            code = error.get('error_code')
+            if code in self.rate_limit_errors:
+                kind = 'rate_limit'
+            elif code in self.transient_errors:
+                kind = 'transient'
+            else:
+                kind = 'fatal'
+            raise vk_api_error(kind, code, error.get('error_msg'),
+                               general_response)
         return general_response['response']
 
+    # call one method with several parameter sets, return list of responses;
+    # when 'use_execute' is enabled up to 25 calls are packed into one
+    # 'execute' request, so they take one slot of the rate limit
+    def do_requests(self, method, params_list):
+        if not self.use_execute:
+            return [self.do_request(method, params) for params in params_list]
+        res = []
+        step = self.max_execute_calls
+        for i in range(0, len(params_list), step):
+            calls = [(method, params) for params in params_list[i:i+step]]
+            res.extend(self.execute(calls))
+        return res
 
-class vk_message:
-    no_id = -1
+    # call several API methods via one 'execute' request,
+    # 'calls' is a list of (method, params) pairs
+    def execute(self, calls):
+        if len(calls) > self.max_execute_calls:
+            raise NameError('vk_api.execute: too many calls: %d' % len(calls))
+        code = 'return [%s];' % ','.join(
+            'API.%s(%s)' % (method, self.vkscript_params(params))
+            for method, params in calls)
+        response = self.do_request('execute', {'code': code})
+        # failed calls are returned as 'false'
+        if False in response:
+            print('VK API execute failed, see dump below', file=sys.stderr)
+            print_json(response, file=sys.stderr)
+            raise NameError('vk_api.execute: error response')
+        return response
 
-    def __init__(self, m, from_cache=False):
-        self.m = m
-        self.from_cache = from_cache
+    # for internal use
+    @staticmethod
+    def vkscript_params(params):
+        res = dict()
+        for key, value in params.items():
+            # lists are passed as comma separated strings like in GET requests
+            if isinstance(value, list):
+                value = ','.join(str(x) for x in value)
+            res[key] = value
+        return json.dumps(res, ensure_ascii=False, sort_keys=True)
 
-    def format(self, users_dict):
-        def format_timestamp(msg):
-            return datetime.fromtimestamp(msg['date'], TZ()).isoformat(' ')
 
-        def format_username_by_id(user_id):
-            if user_id in users_dict:
-                return str(users_dict[user_id])
-            else:
-                return 'user_' + str(user_id)
+# Fields used for storing and grouping messages are kept in slots, the
+# rest of the message only as its encoded JSON, see raw().
+class vk_message:
+    no_id = -1
+    # bump when output of format() changes to re-render all chatlogs
+    format_version = 1
+    __slots__ = ('m_id', 'm_date', 'm_user_id', 'm_out', 'm_chat_id',
+                 'm_title', 'm_participants', 'data', 'from_cache')
+
+    # 'data' is json_line(m) (without the newline) encoded in utf-8 if
+    # it is at hand
+    def __init__(self, m, from_cache=False, data=None):
+        self.m_id = m.get('id', vk_message.no_id)
+        self.m_date = m['date']
+        self.m_user_id = m['user_id']
+        self.m_out = m['out']
+        self.m_chat_id = m.get('chat_id')
+        self.m_title = sys.intern(m['title'])
+        # other users that are mentioned, None for no ones
+        self.m_participants = self.other_participants(m)
+        if data is None:
+            data = json_line(m)[:-1].encode('utf-8')
+        self.data = data
+        self.from_cache = from_cache
 
-        def format_username(msg):
-            if 'out' in msg and msg['out']:
-                user_id = 'me'
-            else:
-                user_id = msg['user_id']
-            return format_username_by_id(user_id)
+    # 'data' is one stored JSON record, str or bytes
+    @staticmethod
+    def from_json(data, from_cache=True):
+        if isinstance(data, str):
+            return vk_message(json_decoder.raw_decode(data)[0], from_cache,
+                              data.encode('utf-8'))
+        return vk_message(json_record(data), from_cache, data)
 
-        def format_forward(msg):
-            fwd = ''
+    # for internal use
+    @staticmethod
+    def other_participants(m):
+        def fwd_participants(msg):
+            fwd_res = set()
             if 'fwd_messages' in msg:
-                fwd_mark = '>>> '
-                fwd_template = '\n' + fwd_mark + '[%s] %s:%s'
                 for fwd_msg in msg['fwd_messages']:
-                    fwd_timestamp = format_timestamp(fwd_msg)
-                    fwd_username = format_username(fwd_msg)
-                    fwd_body = (format_forward(fwd_msg) + fwd_msg['body'])
-                    fwd_body = fwd_body.replace('\n', '\n' + fwd_mark)
-                    fwd += fwd_template % (
-                        fwd_timestamp, fwd_username, fwd_body)
-            if len(fwd) == 0:
-                fwd += ' '
-            else:
-                fwd += '\n'
-            return fwd
-
-        def format_action(msg):
-            if 'action' in msg:
-                action_mark_left = '*** ['
-                action_mark_right = '] ***'
-                if 'action_mid' in msg:
-                    if int(msg['action_mid']) > 0:
-                        act_username = format_username_by_id(
-                            int(msg['action_mid']))
-                    else:
-                        act_username = msg['action_email']
-                if msg['action'] == 'chat_photo_update':
-                    action = 'chat photo updated'
-                elif msg['action'] == 'chat_photo_remove':
-                    action = 'chat photo removed'
-                elif msg['action'] == 'chat_create':
-                    action = 'chat created: ' + msg['action_text']
-                elif msg['action'] == 'chat_title_update':
-                    action = 'chat title updated: ' + msg['action_text']
-                elif msg['action'] == 'chat_invite_user':
-                    action = 'user invited: ' + act_username
-                elif msg['action'] == 'chat_kick_user':
-                    action = 'user kicked: ' + act_username
-                else:
-                    raise NameError('vk_message.format.format_action: '
-                                    'unsupported action type')
-                return action_mark_left + action + action_mark_right
-            else:
-                return ''
-
-        template = '%s[%s] %s:%s%s%s'
-        title = ''
-        more = ''
-
-        # timestamp, username, body
-        timestamp = format_timestamp(self.m)
-        username = format_username(self.m)
-        body = self.m['body']
-        # forward messages if exists
-        fwd = format_forward(self.m)
-        # title if not groupchat message and exists
-        if not self.is_from_groupchat() and self.m['title'].strip() != '...':
-            title = self.m['title'] + '\n'
-
-        # action if exists
-        more += format_action(self.m)
-        # geolocation if exists
-        if 'geo' in self.m:
-            more += '\n    <- ' \
-                'geolocation attached but displaying is not implemented'
-        # media attachments if exists
-        if 'attachments' in self.m:
-            more += '\n    <- ' \
-                'media attachments attached but displaying is not implemented'
+                    fwd_res.add(fwd_msg['user_id'])
+                    fwd_res.update(fwd_participants(fwd_msg))
+            return fwd_res
+        res = fwd_participants(m)
+        action_user_id = int(m.get('action_mid', "0"))
+        if action_user_id > 0:
+            res.add(action_user_id)
+        res.discard(m['user_id'])
+        if len(res) == 0:
+            return None
+        return tuple(sorted(res))
 
-        return template % (title, timestamp, username, fwd, body, more)
+    # use one formatter for many messages, it caches names and timestamps
+    def format(self, users_dict, formatter=None, tz=None):
+        if formatter is None:
+            formatter = vk_message_formatter(users_dict, tz)
+        return formatter.format(self.raw())
 
     def dialog_id(self):
-        if self.is_from_groupchat():
-            return (True, self.m['chat_id'])
+        if self.m_chat_id is not None:
+            return (True, self.m_chat_id)
         else:
-            return (False, self.m['user_id'])
+            return (False, self.m_user_id)
 
+    # decoded on every call, don't keep it for long
     def raw(self):
-        return self.m
+        return json_record(self.data)
 
     def id(self):
-        return self.m.get('id', vk_message.no_id)
+        return self.m_id
 
     def sent(self):
-        return self.m['out']
+        return self.m_out
 
     def is_from_cache(self):
         return self.from_cache
 
     def is_from_groupchat(self):
-        return 'chat_id' in self.m
+        return self.m_chat_id is not None
 
     def participants(self):
-        def fwd_participants(msg):
-            fwd_res = set()
-            if 'fwd_messages' in msg:
-                for fwd_msg in msg['fwd_messages']:
-                    fwd_res.add(fwd_msg['user_id'])
-                    fwd_res.update(fwd_participants(fwd_msg))
-            return fwd_res
-        res = set()
-        res.add(self.m['user_id'])
-        action_user_id = int(self.m.get('action_mid', "0"))
-        if action_user_id > 0:
-            res.add(action_user_id)
-        res.update(fwd_participants(self.m))
+        res = {self.m_user_id}
+        if self.m_participants is not None:
+            res.update(self.m_participants)
         return res
 
+    def date(self):
+        return self.m_date
+
     # for dump filename
     def title(self, users_dict):
-        bad_symbol_re = r'[^a-zA-Z0-9А-ЯЁа-яё «»"\'()?.,:+-]'
         if self.is_from_groupchat():
-            title = self.m['title']
+            title = self.m_title
         else:
-            user_id = self.m['user_id']
-            title = str(users_dict[user_id])
-        return re.sub(bad_symbol_re, '_', title).rstrip('.')
+            title = vk_dialog.user_title(users_dict, self.m_user_id)
+        return sanitize_title(title)
+
+
+# formats raw messages for chatlogs, see vk_message.format()
+class vk_message_formatter:
+    fwd_mark = '>>> '
+    action_mark_left = '*** ['
+    action_mark_right = '] ***'
+    # days since 0001-01-01 for 1970-01-01
+    epoch_ordinal = 719163
+
+    def __init__(self, users_dict, tz=None):
+        self.users_dict = users_dict
+        self.tz = TZ() if tz is None else tz
+        # user id -> formatted name
+        self.names = dict()
+        # utc hour -> (utc offset in seconds, '+HH:MM' suffix) or None if
+        # the offset changes within the hour
+        self.hours = dict()
+        # local day since the epoch -> 'YYYY-MM-DD'
+        self.days = dict()
+
+    # same as datetime.fromtimestamp(timestamp, tz).isoformat(' ')
+    def format_timestamp(self, timestamp):
+        if not isinstance(timestamp, int):
+            return datetime.fromtimestamp(timestamp, self.tz).isoformat(' ')
+        hour = timestamp // 3600
+        if hour not in self.hours:
+            self.hours[hour] = self.hour_offset(hour)
+        hour_offset = self.hours[hour]
+        if hour_offset is None:
+            return datetime.fromtimestamp(timestamp, self.tz).isoformat(' ')
+        offset, suffix = hour_offset
+        day, seconds = divmod(timestamp + offset, 86400)
+        date = self.days.get(day)
+        if date is None:
+            date = date_cls.fromordinal(self.epoch_ordinal + day).isoformat()
+            self.days[day] = date
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return '%s %02d:%02d:%02d%s' % (date, hours, minutes, seconds, suffix)
+
+    # for internal use
+    def hour_offset(self, hour):
+        start = datetime.fromtimestamp(hour * 3600, self.tz)
+        end = datetime.fromtimestamp(hour * 3600 + 3599, self.tz)
+        offset = start.utcoffset()
+        if offset != end.utcoffset() or offset.microseconds != 0:
+            return None
+        return (offset.days * 86400 + offset.seconds,
+                start.isoformat(' ')[len('YYYY-MM-DD HH:MM:SS'):])
+
+    def format_username_by_id(self, user_id):
+        name = self.names.get(user_id)
+        if name is None:
+            if user_id in self.users_dict:
+                name = str(self.users_dict[user_id])
+            else:
+                name = 'user_' + str(user_id)
+            self.names[user_id] = name
+        return name
+
+    def format_username(self, msg):
+        if 'out' in msg and msg['out']:
+            user_id = 'me'
+        else:
+            user_id = msg['user_id']
+        return self.format_username_by_id(user_id)
+
+    def format_forward(self, msg):
+        fwd = ''
+        if 'fwd_messages' in msg:
+            fwd_template = '\n' + self.fwd_mark + '[%s] %s:%s'
+            for fwd_msg in msg['fwd_messages']:
+                fwd_timestamp = self.format_timestamp(fwd_msg['date'])
+                fwd_username = self.format_username(fwd_msg)
+                fwd_body = (self.format_forward(fwd_msg) + fwd_msg['body'])
+                fwd_body = fwd_body.replace('\n', '\n' + self.fwd_mark)
+                fwd += fwd_template % (fwd_timestamp, fwd_username, fwd_body)
+        if len(fwd) == 0:
+            fwd += ' '
+        else:
+            fwd += '\n'
+        return fwd
+
+    def format_action(self, msg):
+        if 'action' not in msg:
+            return ''
+        act_username = None
+        if 'action_mid' in msg:
+            if int(msg['action_mid']) > 0:
+                act_username = self.format_username_by_id(
+                    int(msg['action_mid']))
+            else:
+                act_username = msg['action_email']
+        if msg['action'] == 'chat_photo_update':
+            action = 'chat photo updated'
+        elif msg['action'] == 'chat_photo_remove':
+            action = 'chat photo removed'
+        elif msg['action'] == 'chat_create':
+            action = 'chat created: ' + msg['action_text']
+        elif msg['action'] == 'chat_title_update':
+            action = 'chat title updated: ' + msg['action_text']
+        elif msg['action'] == 'chat_invite_user':
+            action = 'user invited: ' + act_username
+        elif msg['action'] == 'chat_kick_user':
+            action = 'user kicked: ' + act_username
+        else:
+            raise NameError('vk_message_formatter.format_action: '
+                            'unsupported action type')
+        return self.action_mark_left + action + self.action_mark_right
+
+    # 'msg' is a raw message
+    def format(self, msg):
+        template = '%s[%s] %s:%s%s%s'
+        title = ''
+        more = ''
+
+        # timestamp, username, body
+        timestamp = self.format_timestamp(msg['date'])
+        username = self.format_username(msg)
+        body = msg['body']
+        # forward messages if exists
+        fwd = self.format_forward(msg)
+        # title if not groupchat message and exists
+        if 'chat_id' not in msg and msg['title'].strip() != '...':
+            title = msg['title'] + '\n'
+
+        # action if exists
+        more += self.format_action(msg)
+        # geolocation if exists
+        if 'geo' in msg:
+            more += '\n    <- ' \
+                'geolocation attached but displaying is not implemented'
+        # media attachments if exists
+        if 'attachments' in msg:
+            more += '\n    <- ' \
+                'media attachments attached but displaying is not implemented'
+
+        return template % (title, timestamp, username, fwd, body, more)
 
 
 class vk_dialog:
-    def __init__(self, id):
+    dump_buffer_size = 1024 * 1024
+
+    def __init__(self, id, backend):
         self.id = id
-        self.messages = []
-        self.is_sorted = True
+        # where messages are stored, see *_storage_backend classes
+        self.backend = backend
+        # None until messages are read from the storage, ordered by date
+        self.messages = None
+        # ids of the loaded messages, None until then
+        self.ids = None
+        # added messages that are not merged into 'messages' yet, see sort()
+        self.unmerged = []
+        # messages that are not saved to the storage yet and their ids
+        self.new_messages = []
+        self.new_ids = set()
+        self.reset_meta()
+
+    # metadata is kept up to date without loading the messages and is
+    # persisted by the backend
+    def reset_meta(self):
+        self.count = 0
+        # ids of stored messages of a direction are within [first, last]
+        self.first_sent_id = vk_message.no_id
+        self.first_recv_id = vk_message.no_id
+        self.last_sent_id = vk_message.no_id
+        self.last_recv_id = vk_message.no_id
+        self.users_ids = set()
+        self.last_date = None
+        self.chat_title = None
 
+    def update_meta(self, msg):
+        self.count += 1
+        msg_id = msg.id()
+        if msg.sent():
+            self.first_sent_id = self.min_id(self.first_sent_id, msg_id)
+            self.last_sent_id = max(self.last_sent_id, msg_id)
+        else:
+            self.first_recv_id = self.min_id(self.first_recv_id, msg_id)
+            self.last_recv_id = max(self.last_recv_id, msg_id)
+        self.users_ids.add(msg.m_user_id)
+        if msg.m_participants is not None:
+            self.users_ids.update(msg.m_participants)
+        # the same message is the last one after the (stable) sort
+        if self.last_date is None or msg.m_date >= self.last_date:
+            self.last_date = msg.m_date
+            if msg.m_chat_id is not None:
+                self.chat_title = msg.m_title
+
+    # for internal use; no_id is less than any id, but means no id here
+    @staticmethod
+    def min_id(a, b):
+        if a == vk_message.no_id:
+            return b
+        if b == vk_message.no_id:
+            return a
+        return min(a, b)
+
+    def meta(self):
+        return {
+            'count': self.count,
+            'first_sent_id': self.first_sent_id,
+            'first_recv_id': self.first_recv_id,
+            'last_sent_id': self.last_sent_id,
+            'last_recv_id': self.last_recv_id,
+            'participants': sorted(self.users_ids),
+            'last_date': self.last_date,
+            'chat_title': self.chat_title,
+        }
+
+    def set_meta(self, meta):
+        self.count = meta['count']
+        self.first_sent_id = meta['first_sent_id']
+        self.first_recv_id = meta['first_recv_id']
+        self.last_sent_id = meta['last_sent_id']
+        self.last_recv_id = meta['last_recv_id']
+        self.users_ids = set(meta['participants'])
+        self.last_date = meta['last_date']
+        self.chat_title = meta['chat_title']
+
+    # return False for a message that is added already
     def add_message(self, msg):
         if msg.dialog_id() != self.id:
             raise NameError('vk_dialog.add_message: '
                             'expected %s dialog id for message, got %s' %
                             (self.id, msg.dialog_id()))
-        self.messages.append(msg)
-        self.is_sorted = False
+        if self.is_known(msg):
+            return False
+        self.update_meta(msg)
+        if not msg.is_from_cache():
+            self.new_messages.append(msg)
+            self.new_ids.add(msg.id())
+        if self.messages is not None:
+            self.ids.add(msg.id())
+            # messages mostly come in order and are just appended
+            if len(self.unmerged) == 0 and (len(self.messages) == 0 or
+                                            msg.m_date >=
+                                            self.messages[-1].m_date):
+                self.messages.append(msg)
+            else:
+                self.unmerged.append(msg)
+        return True
+
+    # for internal use; ids grow with time and pages of a download go
+    # newest first, so new messages are out of the range of already known
+    # ids of their direction; only a message within it may be stored
+    # already, the dialog is loaded to check it then
+    def is_known(self, msg):
+        msg_id = msg.id()
+        if msg_id == vk_message.no_id:
+            return False
+        if msg_id in self.new_ids:
+            return True
+        if self.ids is None:
+            if msg.sent():
+                first_id, last_id = self.first_sent_id, self.last_sent_id
+            else:
+                first_id, last_id = self.first_recv_id, self.last_recv_id
+            if msg_id > last_id or msg_id < first_id:
+                return False
+            self.load()
+        return msg_id in self.ids
 
-    # assume (is_from_groupchat, chatid_/user_id) id format
-    def filename(self):
+    def is_dirty(self):
+        return len(self.new_messages) > 0 or \
+            self.backend.needs_rewrite(self.id)
+
+    def is_loaded(self):
+        return self.messages is not None
+
+    def name(self):
+        return self.id_to_name(self.id)
+
+    def title(self, users_dict):
+        return sanitize_title(self.raw_title(users_dict))
+
+    # the chat title or the user name as is
+    def raw_title(self, users_dict):
         if self.id[0]:
-            return 'groupchat_%d.json' % self.id[1]
-        else:
-            return 'userchat_%d.json' % self.id[1]
+            return self.chat_title
+        return self.user_title(users_dict, self.id[1])
 
-    # assume that all dialogs has different titles
+    # a user that is not downloaded (yet) is named like in chatlogs
+    @staticmethod
+    def user_title(users_dict, user_id):
+        user = users_dict.get(user_id)
+        if user is None:
+            return 'user_' + str(user_id)
+        return str(user)
+
+    # a chatlog name without vk_dialog_titles, titles may collide
     def dump_filename(self, users_dict):
-        return self.messages[-1].title(users_dict) + '.txt'
+        return self.title(users_dict) + '.txt'
 
+    # merge added messages into the loaded ones; only messages newer than
+    # the oldest added one are touched, timsort merges the two sorted runs
+    # linearly (and faster than heapq.merge); equal dates keep the order
+    # of adding
     def sort(self):
-        if self.is_sorted:
+        if len(self.unmerged) == 0:
+            return
+        self.unmerged.sort(key=attrgetter('m_date'))
+        first_date = self.unmerged[0].m_date
+        lo, hi = 0, len(self.messages)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.messages[mid].m_date <= first_date:
+                lo = mid + 1
+            else:
+                hi = mid
+        tail = self.messages[lo:] + self.unmerged
+        tail.sort(key=attrgetter('m_date'))
+        self.messages[lo:] = tail
+        self.unmerged = []
+
+    # pass new messages to the backend; a dialog in an old format is
+    # rewritten as a whole
+    def save(self):
+        if not self.is_dirty():
+            return
+        if self.backend.needs_rewrite(self.id):
+            self.load()
+            self.sort()
+            self.backend.rewrite(self.id, self.messages)
+        else:
+            self.backend.append(self.id, self.new_messages)
+        for msg in self.new_messages:
+            msg.from_cache = True
+        self.new_messages = []
+        self.new_ids = set()
+
+    # read messages from the storage (if not read yet); stored messages are
+    # taken as is, added ones are checked against them
+    def load(self):
+        if self.is_loaded():
             return
-        self.messages.sort(key=lambda msg: msg.raw()['date'])
-        self.is_sorted = True
+        new_messages = self.new_messages
+        self.new_messages = []
+        self.new_ids = set()
+        self.reset_meta()
+        messages, is_sorted = self.backend.read(self.id)
+        if not is_sorted:
+            # the storage order is mostly sorted, that is linear for timsort
+            messages.sort(key=attrgetter('m_date'))
+        for msg in messages:
+            self.update_meta(msg)
+        self.messages = messages
+        self.ids = set(msg.id() for msg in messages)
+        for msg in new_messages:
+            self.add_message(msg)
 
-    def save(self, storage_dir):
-        self.sort()
-        filepath = os.path.join(storage_dir, self.filename())
-        data = [msg.raw() for msg in self.messages]
-        with open(filepath, 'w') as f:
-            print_json(data, file=f)
+    # messages stored after the backend position 'position'
+    def read_tail(self, position):
+        return self.backend.read_tail(self.id, position)
+
+    # messages stored since the dialog had 'count' messages at 'position';
+    # None when they cannot be told apart (the dialog was rewritten or has
+    # unsaved messages)
+    def read_tail_since(self, position, count):
+        if self.is_dirty() or self.position() < position:
+            return None
+        if self.position() == position and self.count == count:
+            return []
+        tail = self.read_tail(position)
+        if count + len(tail) != self.count:
+            return None
+        return tail
 
-    def dump(self, dump_dir, users_dict):
+    # opaque marker of the stored messages, see read_tail()
+    def position(self):
+        return self.backend.position(self.id)
+
+    # free memory, metadata is kept
+    def unload(self):
+        if self.is_loaded():
+            self.messages = None
+            self.ids = None
+            self.unmerged = []
+
+    # formatted messages are written one by one through the file buffer,
+    # the whole chatlog is never kept in memory
+    @staticmethod
+    def format_lines(messages, users_dict, tz=None):
+        formatter = vk_message_formatter(users_dict, tz)
+        for msg in messages:
+            yield msg.format(users_dict, formatter) + '\n'
+
+    # with 'transaction' the chatlog is replaced on its commit;
+    # 'dump_filename' is dump_filename() by default
+    def dump(self, dump_dir, users_dict, tz=None, transaction=None,
+             dump_filename=None):
         self.sort()
-        filepath = os.path.join(dump_dir, self.dump_filename(users_dict))
-        data = ''
-        for msg in self.messages:
-            data += msg.format(users_dict) + '\n'
-        with open(filepath, 'w') as f:
-            f.write(data)
+        if dump_filename is None:
+            dump_filename = self.dump_filename(users_dict)
+        filepath = os.path.join(dump_dir, dump_filename)
+        if transaction is None:
+            f = open(filepath, 'w', buffering=self.dump_buffer_size)
+        else:
+            f = transaction.open(filepath, 'w',
+                                 buffering=self.dump_buffer_size)
+        with f:
+            f.writelines(self.format_lines(self.messages, users_dict, tz))
+
+    # append messages that are newer than the already rendered ones
+    def dump_unrendered(self, dump_dir, users_dict, messages, tz=None,
+                        transaction=None, dump_filename=None):
+        messages = sorted(messages, key=attrgetter('m_date'))
+        if dump_filename is None:
+            dump_filename = self.dump_filename(users_dict)
+        filepath = os.path.join(dump_dir, dump_filename)
+        with open(filepath, 'a', buffering=self.dump_buffer_size) as f:
+            f.writelines(self.format_lines(messages, users_dict, tz))
+        if transaction is not None:
+            transaction.add_synced(filepath)
+
+    # changes when any text that format() takes from users_dict changes or
+    # timestamps are shown in other timezone
+    def render_fingerprint(self, users_dict, tz=None):
+        names = []
+        for user_id in sorted(self.users_ids) + ['me']:
+            user = users_dict.get(user_id)
+            names.append(None if user is None else str(user))
+        fields = [vk_message.format_version, names]
+        # the default timezone keeps fingerprints of older versions
+        if tz is not None and timezone_name(tz) is not None:
+            fields.append(timezone_name(tz))
+        data = json.dumps(fields, ensure_ascii=False)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
 
     def get_messages(self):
+        self.load()
         self.sort()
         return self.messages
 
     # return set of users' IDs
     def participants(self):
-        users_ids = set()
-        for msg in self.messages:
-            users_ids.update(msg.participants())
-        return users_ids
+        return self.users_ids
 
     # assume (is_from_groupchat, chatid_/user_id) id format
+    @staticmethod
+    def id_to_name(dialog_id):
+        if dialog_id[0]:
+            return 'groupchat_%d' % dialog_id[1]
+        else:
+            return 'userchat_%d' % dialog_id[1]
+
+    @staticmethod
+    def name_to_id(name):
+        m = re.match(r'(userchat|groupchat)_(\d+)$', name)
+        if m:
+            return (m.group(1) == 'groupchat', int(m.group(2)))
+        else:
+            return None
+
     @staticmethod
     def filepath_to_id(filepath):
         filename = os.path.basename(filepath)
-        m = re.match(r'(userchat|groupchat)_(\d+).json', filename)
+        m = re.match(r'(.*)\.jsonl?$', filename)
         if m:
-            return (m.group(1) == 'groupchat', int(m.group(2)))
+            return vk_dialog.name_to_id(m.group(1))
         else:
             return None
 
 
+# Storage backends keep dialogs' messages and metadata. The interface:
+#
+# * load_dialogs() -- list of (dialog_id, meta) for stored dialogs, meta
+#   is None when it is unknown and must be rebuilt from the messages;
+# * read(dialog_id) -- (vk_message objects, whether they are sorted by
+#   date);
+# * append(dialog_id, messages), rewrite(dialog_id, messages);
+# * needs_rewrite(dialog_id) -- dialog is stored in an old format;
+# * position(dialog_id), read_tail(dialog_id, position) -- messages
+#   appended after a position;
+# * sync() -- make appended messages durable;
+# * commit(dialogs) -- persist metadata of changed vk_dialog objects.
+
+# one JSON Lines file per dialog and manifest.json with the metadata;
+# the manifest is the commit record: it is replaced only after the files
+# are synced, and records after the committed size of a file (left by an
+# interrupted run) are checked and cut at the first damaged one
+class jsonl_storage_backend:
+    format_name = 'jsonl'
+    manifest_filename = 'manifest.json'
+    manifest_version = 2
+
+    def __init__(self, storage_dir):
+        self.storage_dir = storage_dir
+        # storage filename -> dialog metadata with file size and mtime
+        self.manifest = dict()
+        self.manifest_is_stale = False
+        # ids of dialogs stored as old-style json arrays
+        self.legacy_ids = set()
+        # dialog id -> size of correctly parsed prefix of the file
+        self.valid_sizes = dict()
+        # files appended since the last sync()
+        self.appended = set()
+
+    @staticmethod
+    def filename(dialog_id, legacy=False):
+        name = vk_dialog.id_to_name(dialog_id)
+        return name + ('.json' if legacy else '.jsonl')
+
+    # for internal use
+    def filepath(self, dialog_id):
+        legacy = dialog_id in self.legacy_ids
+        return os.path.join(self.storage_dir,
+                            self.filename(dialog_id, legacy))
+
+    def load_dialogs(self):
+        res = []
+        if not os.path.isdir(self.storage_dir):
+            return res
+        self.load_manifest()
+        filenames = set(os.listdir(self.storage_dir))
+        for filename in sorted(filenames):
+            filepath = os.path.join(self.storage_dir, filename)
+            dialog_id = vk_dialog.filepath_to_id(filepath)
+            # skip files that not matching vk_dialog naming scheme
+            if dialog_id is None:
+                continue
+            # a legacy file left after an interrupted migration
+            if filename.endswith('.json') and filename + 'l' in filenames:
+                logging.warning('Ignoring %s, %sl is already migrated',
+                                filename, filename)
+                continue
+            if not os.path.isfile(filepath):
+                raise NameError('jsonl_storage_backend.load_dialogs: '
+                                '%s is not regular file' % filepath)
+            if filename.endswith('.json'):
+                self.legacy_ids.add(dialog_id)
+            if self.manifest_entry_is_fresh(filename):
+                res.append((dialog_id, self.manifest[filename]))
+            else:
+                res.append((dialog_id, None))
+                self.manifest_is_stale = True
+        # forget removed files
+        for filename in list(self.manifest.keys()):
+            if filename not in filenames:
+                del self.manifest[filename]
+                self.manifest_is_stale = True
+        return res
+
+    def read(self, dialog_id):
+        filepath = self.filepath(dialog_id)
+        if not os.path.exists(filepath):
+            return [], True
+        if dialog_id in self.legacy_ids:
+            with open(filepath, 'r') as f:
+                return [vk_message(raw_msg, from_cache=True)
+                        for raw_msg in json.load(f)], False
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        lines = data.split(b'\n')
+        # the last element is empty when the file ends with a newline
+        tail = lines.pop()
+        if len(tail) > 0:
+            logging.warning('Dropping incomplete record at the end of %s',
+                            filepath)
+            self.valid_sizes[dialog_id] = len(data) - len(tail)
+        try:
+            return [vk_message.from_json(line) for line in lines], False
+        except (ValueError, KeyError):
+            return self.read_valid(dialog_id, lines), False
+
+    # for internal use; messages before the first damaged record, that is
+    # allowed only after the committed size
+    def read_valid(self, dialog_id, lines):
+        filepath = self.filepath(dialog_id)
+        entry = self.manifest.get(os.path.basename(filepath), {})
+        messages = []
+        size = 0
+        for line in lines:
+            try:
+                messages.append(vk_message.from_json(line))
+            except (ValueError, KeyError):
+                if size < entry.get('size', 0):
+                    raise NameError('jsonl_storage_backend.read: '
+                                    'damaged record at offset %d of %s' %
+                                    (size, filepath))
+                logging.warning('Dropping damaged records at the end of %s',
+                                filepath)
+                self.valid_sizes[dialog_id] = size
+                break
+            size += len(line) + 1
+        return messages
+
+    def append(self, dialog_id, messages):
+        safe_mkdir(self.storage_dir)
+        filepath = self.filepath(dialog_id)
+        # drop a partially written line left by an interrupted run
+        if dialog_id in self.valid_sizes:
+            os.truncate(filepath, self.valid_sizes.pop(dialog_id))
+        with open(filepath, 'ab') as f:
+            for msg in messages:
+                f.write(msg.data + b'\n')
+        self.appended.add(filepath)
+
+    # the new file is committed at once, the old one is removed after that
+    def rewrite(self, dialog_id, messages):
+        safe_mkdir(self.storage_dir)
+        old_filepath = self.filepath(dialog_id)
+        filepath = os.path.join(self.storage_dir, self.filename(dialog_id))
+        transaction = file_transaction()
+        with transaction.open(filepath, 'wb') as f:
+            for msg in messages:
+                f.write(msg.data + b'\n')
+        transaction.commit()
+        if old_filepath != filepath:
+            os.remove(old_filepath)
+            self.manifest.pop(os.path.basename(old_filepath), None)
+        self.legacy_ids.discard(dialog_id)
+        self.valid_sizes.pop(dialog_id, None)
+
+    def needs_rewrite(self, dialog_id):
+        return dialog_id in self.legacy_ids
+
+    # the file is append-only, so its size is a position
+    def position(self, dialog_id):
+        filepath = self.filepath(dialog_id)
+        if not os.path.exists(filepath):
+            return 0
+        return os.path.getsize(filepath)
+
+    def read_tail(self, dialog_id, position):
+        if position > self.position(dialog_id):
+            raise NameError('jsonl_storage_backend.read_tail: '
+                            'file is truncated: %s' % self.filepath(dialog_id))
+        with open(self.filepath(dialog_id), 'rb') as f:
+            f.seek(position)
+            data = f.read()
+        lines = data.split(b'\n')
+        lines.pop()
+        return [vk_message.from_json(line) for line in lines]
+
+    # damaged records found by read() are cut here as well
+    def sync(self):
+        for dialog_id, size in self.valid_sizes.items():
+            filepath = self.filepath(dialog_id)
+            os.truncate(filepath, size)
+            self.appended.add(filepath)
+        self.valid_sizes = dict()
+        transaction = file_transaction()
+        for filepath in self.appended:
+            transaction.add_synced(filepath)
+        transaction.commit()
+        self.appended = set()
+
+    def commit(self, dialogs):
+        self.sync()
+        for dialog in dialogs:
+            self.update_manifest(dialog)
+        if len(dialogs) > 0 or self.manifest_is_stale:
+            self.save_manifest()
+
+    def close(self):
+        pass
+
+    # for internal use
+    def load_manifest(self):
+        filepath = os.path.join(self.storage_dir, self.manifest_filename)
+        if not os.path.isfile(filepath):
+            return
+        with open(filepath, 'r', encoding='utf-8') as f:
+            try:
+                data = json.load(f)
+            except ValueError:
+                logging.warning('Cannot parse %s, rebuilding it', filepath)
+                return
+        if data.get('version') != self.manifest_version:
+            return
+        self.manifest = data['dialogs']
+
+    # for internal use
+    def save_manifest(self):
+        safe_mkdir(self.storage_dir)
+        filepath = os.path.join(self.storage_dir, self.manifest_filename)
+        data = {
+            'version': self.manifest_version,
+            'dialogs': self.manifest,
+        }
+        transaction = file_transaction()
+        with transaction.open(filepath, 'w', encoding='utf-8') as f:
+            print_json(data, file=f)
+        transaction.commit()
+        self.manifest_is_stale = False
+
+    # for internal use
+    def manifest_entry_is_fresh(self, filename):
+        if filename not in self.manifest:
+            return False
+        entry = self.manifest[filename]
+        st = os.stat(os.path.join(self.storage_dir, filename))
+        return entry['size'] == st.st_size and \
+            entry['mtime_ns'] == st.st_mtime_ns
+
+    # for internal use
+    def update_manifest(self, dialog):
+        filepath = self.filepath(dialog.id)
+        st = os.stat(filepath)
+        entry = dialog.meta()
+        entry['size'] = st.st_size
+        entry['mtime_ns'] = st.st_mtime_ns
+        self.manifest[os.path.basename(filepath)] = entry
+
+
+# one SQLite database: messages are keyed by id and indexed by dialog
+# and date, metadata is kept in the 'dialogs' and 'participants' tables
+class sqlite_storage_backend:
+    format_name = 'sqlite'
+    db_filename = 'messages.sqlite'
+    imported_dir = 'imported'
+    schema = '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            dialog TEXT NOT NULL,
+            date INTEGER NOT NULL,
+            out INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            raw TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_dialog_date
+            ON messages (dialog, date, seq);
+        CREATE INDEX IF NOT EXISTS messages_dialog_seq
+            ON messages (dialog, seq);
+        CREATE TABLE IF NOT EXISTS dialogs (
+            dialog TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            last_sent_id INTEGER NOT NULL,
+            last_recv_id INTEGER NOT NULL,
+            last_date INTEGER,
+            chat_title TEXT,
+            first_sent_id INTEGER NOT NULL,
+            first_recv_id INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS participants (
+            dialog TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (dialog, user_id)
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, storage_dir):
+        self.storage_dir = storage_dir
+        self.db = None
+        # insertion order of messages, the position for read_tail()
+        self.seq = 0
+
+    # for internal use
+    def connect(self):
+        if self.db is not None:
+            return
+        safe_mkdir(self.storage_dir)
+        filepath = os.path.join(self.storage_dir, self.db_filename)
+        self.db = sqlite3.connect(filepath)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.schema)
+        self.add_first_ids()
+        self.seq = self.db.execute(
+            'SELECT coalesce(max(seq), 0) FROM messages').fetchone()[0]
+
+    # for internal use; databases of older versions have no first ids
+    def add_first_ids(self):
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(dialogs)')]
+        if 'first_sent_id' in columns:
+            return
+        for column, out in (('first_sent_id', 1), ('first_recv_id', 0)):
+            self.db.execute(
+                'ALTER TABLE dialogs ADD COLUMN %s INTEGER NOT NULL '
+                'DEFAULT %d' % (column, vk_message.no_id))
+            self.db.execute(
+                'UPDATE dialogs SET %s = coalesce((SELECT min(id) '
+                'FROM messages WHERE messages.dialog = dialogs.dialog '
+                'AND out = ?), ?)' % column, (out, vk_message.no_id))
+        self.db.commit()
+
+    def load_dialogs(self):
+        if not os.path.isdir(self.storage_dir):
+            return []
+        self.connect()
+        self.migrate()
+        participants = dict()
+        for name, user_id in self.db.execute(
+                'SELECT dialog, user_id FROM participants'):
+            participants.setdefault(name, []).append(user_id)
+        res = []
+        for row in self.db.execute(
+                'SELECT dialog, count, last_sent_id, last_recv_id, '
+                'last_date, chat_title, first_sent_id, first_recv_id '
+                'FROM dialogs ORDER BY dialog'):
+            res.append((vk_dialog.name_to_id(row[0]), {
+                'count': row[1],
+                'last_sent_id': row[2],
+                'last_recv_id': row[3],
+                'last_date': row[4],
+                'chat_title': row[5],
+                'first_sent_id': row[6],
+                'first_recv_id': row[7],
+                'participants': participants.get(row[0], []),
+            }))
+        return res
+
+    # import dialogs from json / jsonl files into an empty database
+    def migrate(self):
+        if self.db.execute('SELECT count(*) FROM dialogs').fetchone()[0] > 0:
+            # the run that imported them was interrupted
+            self.move_imported()
+            return
+        jsonl_backend = jsonl_storage_backend(self.storage_dir)
+        dialogs = jsonl_backend.load_dialogs()
+        if len(dialogs) == 0:
+            return
+        logging.info('Importing %d dialogs into %s...', len(dialogs),
+                     self.db_filename)
+        imported = []
+        for dialog_id, _ in dialogs:
+            dialog = vk_dialog(dialog_id, self)
+            messages, _ = jsonl_backend.read(dialog_id)
+            for msg in messages:
+                msg.from_cache = False
+                dialog.add_message(msg)
+            dialog.save()
+            imported.append(dialog)
+        self.commit(imported)
+        self.move_imported()
+
+    # for internal use; imported files are moved to 'imported_dir', so they
+    # are never read as a current jsonl storage
+    def move_imported(self):
+        filenames = [filename for filename in os.listdir(self.storage_dir)
+                     if vk_dialog.filepath_to_id(filename) is not None]
+        if len(filenames) == 0:
+            return
+        filenames.append(jsonl_storage_backend.manifest_filename)
+        imported_dir = os.path.join(self.storage_dir, self.imported_dir)
+        safe_mkdir(imported_dir)
+        for filename in filenames:
+            filepath = os.path.join(self.storage_dir, filename)
+            if os.path.exists(filepath):
+                os.replace(filepath, os.path.join(imported_dir, filename))
+        logging.info('Imported files are moved to %s', imported_dir)
+
+    def read(self, dialog_id):
+        self.connect()
+        rows = self.db.execute(
+            'SELECT raw FROM messages WHERE dialog = ? ORDER BY date, seq',
+            (vk_dialog.id_to_name(dialog_id),))
+        return [vk_message.from_json(row[0]) for row in rows], True
+
+    def append(self, dialog_id, messages):
+        self.connect()
+        name = vk_dialog.id_to_name(dialog_id)
+        rows = []
+        for msg in messages:
+            self.seq += 1
+            rows.append((msg.id(), name, msg.date(), int(msg.sent()),
+                         self.seq, msg.data.decode('utf-8')))
+        # a message that is already stored is not duplicated
+        self.db.executemany(
+            'INSERT OR IGNORE INTO messages (id, dialog, date, out, seq, raw) '
+            'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def rewrite(self, dialog_id, messages):
+        self.connect()
+        self.db.execute('DELETE FROM messages WHERE dialog = ?',
+                        (vk_dialog.id_to_name(dialog_id),))
+        self.append(dialog_id, messages)
+
+    def needs_rewrite(self, dialog_id):
+        return False
+
+    def position(self, dialog_id):
+        self.connect()
+        return self.db.execute(
+            'SELECT coalesce(max(seq), 0) FROM messages WHERE dialog = ?',
+            (vk_dialog.id_to_name(dialog_id),)).fetchone()[0]
+
+    def read_tail(self, dialog_id, position):
+        self.connect()
+        rows = self.db.execute(
+            'SELECT raw FROM messages WHERE dialog = ? AND seq > ? '
+            'ORDER BY seq', (vk_dialog.id_to_name(dialog_id), position))
+        return [vk_message.from_json(row[0]) for row in rows]
+
+    def sync(self):
+        if self.db is not None:
+            self.db.commit()
+
+    def commit(self, dialogs):
+        if len(dialogs) == 0:
+            return
+        self.connect()
+        for dialog in dialogs:
+            name = dialog.name()
+            # duplicates are ignored by append()
+            dialog.count = self.db.execute(
+                'SELECT count(*) FROM messages WHERE dialog = ?',
+                (name,)).fetchone()[0]
+            self.db.execute(
+                'INSERT OR REPLACE INTO dialogs (dialog, count, '
+                'last_sent_id, last_recv_id, last_date, chat_title, '
+                'first_sent_id, first_recv_id) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, dialog.count, dialog.last_sent_id,
+                 dialog.last_recv_id, dialog.last_date, dialog.chat_title,
+                 dialog.first_sent_id, dialog.first_recv_id))
+            self.db.executemany(
+                'INSERT OR IGNORE INTO participants (dialog, user_id) '
+                'VALUES (?, ?)',
+                [(name, user_id) for user_id in dialog.users_ids])
+        self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+storage_backends = {
+    'jsonl': jsonl_storage_backend,
+    'sqlite': sqlite_storage_backend,
+}
+
+
+# 'storage_format' is a key of storage_backends; by default an existing
+# SQLite database is used if any
+# a storage imported into sqlite cannot go back to jsonl: its files would
+# be read as a stale copy of the messages
+def create_storage_backend(storage_dir, storage_format=None):
+    db_filepath = os.path.join(storage_dir,
+                               sqlite_storage_backend.db_filename)
+    has_db = os.path.exists(db_filepath)
+    if storage_format is None:
+        storage_format = 'sqlite' if has_db else 'jsonl'
+    if storage_format not in storage_backends:
+        raise NameError('create_storage_backend: unknown storage format: %s' %
+                        storage_format)
+    if storage_format == 'jsonl' and has_db:
+        raise NameError('create_storage_backend: %s keeps messages in %s, '
+                        'use --storage-format sqlite' %
+                        (storage_dir, sqlite_storage_backend.db_filename))
+    return storage_backends[storage_format](storage_dir)
+
+
+# full-text index of stored messages (SQLite FTS5) for the 'search'
+# command; kept up to date by vk_messages_storage, it remembers the
+# backend position of every indexed dialog, like the render state does
+class vk_search_index:
+    db_filename = 'search.sqlite'
+    version = 1
+    schema = '''
+        CREATE TABLE IF NOT EXISTS info (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS dialogs (
+            dialog TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            count INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            dialog TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            out INTEGER NOT NULL,
+            date INTEGER NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_dialog ON messages (dialog);
+        CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING fts5 (
+            text, content = 'messages', content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        );
+    '''
+    # rows are inserted by that many (old sqlite allows 999 parameters)
+    batch_size = 500
+
+    # 'backend_name' is the class name of the storage backend, positions
+    # of other backends are meaningless
+    def __init__(self, storage_dir, backend_name):
+        self.storage_dir = storage_dir
+        self.backend_name = backend_name
+        self.db = None
+        # set when sqlite is built without FTS5
+        self.is_disabled = False
+        # rows of messages table that are not inserted yet
+        self.pending = []
+
+    # for internal use
+    def connect(self):
+        if self.db is not None or self.is_disabled:
+            return
+        safe_mkdir(self.storage_dir)
+        filepath = os.path.join(self.storage_dir, self.db_filename)
+        self.db = sqlite3.connect(filepath)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # the index follows the storage (see sync()), so losing its last
+        # transactions on a power failure is fine, while syncing every one
+        # of them is not
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        try:
+            self.db.executescript(self.schema)
+        except sqlite3.OperationalError as e:
+            logging.warning('Search index is disabled: %s', e)
+            self.db.close()
+            self.db = None
+            self.is_disabled = True
+            return
+        if self.get_info('version') != str(self.version) or \
+                self.get_info('backend') != self.backend_name:
+            self.db.execute('DELETE FROM dialogs')
+            self.db.execute('DELETE FROM messages')
+            self.db.execute("INSERT INTO messages_text (messages_text) "
+                            "VALUES ('delete-all')")
+            self.set_info('version', str(self.version))
+            self.set_info('backend', self.backend_name)
+            self.db.commit()
+
+    # for internal use
+    def get_info(self, key):
+        row = self.db.execute('SELECT value FROM info WHERE key = ?',
+                              (key,)).fetchone()
+        return None if row is None else row[0]
+
+    # for internal use
+    def set_info(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO info VALUES (?, ?)',
+                        (key, value))
+
+    # body with bodies of forwarded messages and action texts
+    @staticmethod
+    def message_text(msg):
+        parts = [msg['body']]
+        if 'action_text' in msg:
+            parts.append(msg['action_text'])
+        for fwd_msg in msg.get('fwd_messages', ()):
+            parts.append(vk_search_index.message_text(fwd_msg))
+        return '\n'.join(parts)
+
+    # messages that are indexed already are skipped
+    def add_message(self, msg):
+        if self.is_disabled:
+            return
+        raw = msg.raw()
+        self.pending.append((msg.id(), vk_dialog.id_to_name(msg.dialog_id()),
+                             raw['user_id'], int(msg.sent()), raw['date'],
+                             self.message_text(raw)))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    # messages_text is filled here rather than by a trigger, that is
+    # several times faster
+    def flush(self):
+        self.connect()
+        if self.is_disabled or len(self.pending) == 0:
+            return
+        rows = dict()
+        for row in self.pending:
+            rows.setdefault(row[0], row)
+        self.pending = []
+        ids = list(rows.keys())
+        for i in range(0, len(ids), self.batch_size):
+            chunk = ids[i:i+self.batch_size]
+            for row in self.db.execute(
+                    'SELECT id FROM messages WHERE id IN (%s)' %
+                    ','.join('?' * len(chunk)), chunk):
+                del rows[row[0]]
+        # both tables are faster to fill in the rowid order
+        rows = sorted(rows.values())
+        self.db.executemany(
+            'INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.db.executemany(
+            'INSERT INTO messages_text (rowid, text) VALUES (?, ?)',
+            [(row[0], row[5]) for row in rows])
+        # indexed messages of not committed dialogs are skipped by sync()
+        self.db.commit()
+
+    # remember what is indexed for saved dialogs
+    def commit(self, dialogs):
+        self.flush()
+        if self.is_disabled:
+            return
+        self.db.executemany(
+            'INSERT OR REPLACE INTO dialogs VALUES (?, ?, ?)',
+            [(dialog.name(), dialog.position(), dialog.count)
+             for dialog in dialogs])
+        self.db.commit()
+
+    # index messages stored by earlier runs or without the index
+    def sync(self, dialogs):
+        self.connect()
+        if self.is_disabled:
+            return
+        indexed = dict()
+        for name, position, count in self.db.execute(
+                'SELECT dialog, position, count FROM dialogs'):
+            indexed[name] = (position, count)
+        # forget dialogs removed from the storage
+        names = set(dialog.name() for dialog in dialogs)
+        for name in set(indexed.keys()) - names:
+            self.remove_dialog(name)
+        synced = []
+        for dialog in dialogs:
+            entry = indexed.get(dialog.name())
+            tail = None
+            if entry is not None:
+                tail = dialog.read_tail_since(*entry)
+            if tail is None:
+                self.reindex(dialog)
+            elif len(tail) == 0:
+                continue
+            else:
+                for msg in tail:
+                    self.add_message(msg)
+            # unsaved dialogs are committed by vk_messages_storage.save()
+            if not dialog.is_dirty():
+                synced.append(dialog)
+        if len(synced) > 0:
+            logging.info('Search index updated for %d dialogs', len(synced))
+        self.commit(synced)
+
+    # for internal use
+    def remove_dialog(self, name):
+        self.flush()
+        self.db.execute("INSERT INTO messages_text (messages_text, rowid, "
+                        "text) SELECT 'delete', id, text FROM messages "
+                        "WHERE dialog = ?", (name,))
+        self.db.execute('DELETE FROM messages WHERE dialog = ?', (name,))
+        self.db.execute('DELETE FROM dialogs WHERE dialog = ?', (name,))
+
+    # for internal use
+    def reindex(self, dialog):
+        self.remove_dialog(dialog.name())
+        was_loaded = dialog.is_loaded()
+        for msg in dialog.get_messages():
+            self.add_message(msg)
+        if not was_loaded:
+            dialog.unload()
+
+    # every word of 'query' must be found, see FTS5 query syntax for
+    # 'fts_query'; 'out' is True for own messages; return list of
+    # (dialog name, user_id, out, date, snippet), newest first
+    def search(self, query, dialog=None, user_id=None, out=None, since=None,
+               until=None, limit=None, fts_query=False):
+        self.flush()
+        if self.is_disabled:
+            raise NameError('vk_search_index.search: sqlite is built '
+                            'without FTS5, search is not available')
+        if not fts_query:
+            query = ' '.join('"%s"' % word.replace('"', '""')
+                             for word in query.split())
+        # '+' keeps sqlite from scanning a dialog and matching every
+        # message of it, the text index is always searched first
+        conditions = ['messages_text MATCH ?']
+        params = [query]
+        if dialog is not None:
+            conditions.append('+m.dialog = ?')
+            params.append(dialog)
+        if user_id is not None:
+            conditions.append('+m.user_id = ?')
+            params.append(user_id)
+        if out is not None:
+            conditions.append('+m.out = ?')
+            params.append(int(out))
+        if since is not None:
+            conditions.append('+m.date >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('+m.date < ?')
+            params.append(until)
+        sql = 'SELECT m.id, m.dialog, m.user_id, m.out, m.date ' \
+            'FROM messages_text JOIN messages AS m ' \
+            'ON m.id = messages_text.rowid WHERE ' + \
+            ' AND '.join(conditions) + ' ORDER BY m.date DESC, m.id DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        try:
+            rows = self.db.execute(sql, params).fetchall()
+            # snippets only for the shown messages
+            snippets = dict()
+            for i in range(0, len(rows), self.batch_size):
+                ids = [row[0] for row in rows[i:i+self.batch_size]]
+                snippets.update(self.db.execute(
+                    "SELECT rowid, snippet(messages_text, 0, '*', '*', "
+                    "'...', 24) FROM messages_text WHERE messages_text "
+                    'MATCH ? AND rowid IN (%s)' % ','.join('?' * len(ids)),
+                    [query] + ids))
+        except sqlite3.OperationalError as e:
+            raise NameError('vk_search_index.search: bad query: %s' % e)
+        return [row[1:] + (snippets[row[0]],) for row in rows]
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+# Chatlog filenames of dialogs, kept in titles.json: dialog name ->
+# {'source': chat title or user name, 'title', 'filename'}. A title is
+# sanitized again only when its source changes. Dialogs with the same
+# title (compared case-insensitively, like some filesystems do) get their
+# names appended, 'Title (userchat_123).txt', so they never overwrite
+# each other's chatlogs and the choice does not depend on the order of
+# dialogs.
+class vk_dialog_titles:
+    filename = 'titles.json'
+    version = 1
+
+    def __init__(self, storage_dir):
+        self.storage_dir = storage_dir
+        self.entries = dict()
+        self.is_changed = False
+
+    def load(self):
+        self.entries = dict()
+        filepath = os.path.join(self.storage_dir, self.filename)
+        if not os.path.isfile(filepath):
+            return
+        with open(filepath, 'r', encoding='utf-8') as f:
+            try:
+                data = json.load(f)
+            except ValueError:
+                logging.warning('Cannot parse %s, building it again',
+                                filepath)
+                return
+        if data.get('version') == self.version:
+            self.entries = data['dialogs']
+
+    def save(self):
+        if not self.is_changed:
+            return
+        safe_mkdir(self.storage_dir)
+        data = {
+            'version': self.version,
+            'dialogs': self.entries,
+        }
+        transaction = file_transaction()
+        with transaction.open(os.path.join(self.storage_dir, self.filename),
+                              'w', encoding='utf-8') as f:
+            print_json(data, file=f)
+        transaction.commit()
+        self.is_changed = False
+
+    # bring filenames of 'dialogs' up to date
+    def update(self, dialogs, users_dict):
+        # dialog name -> sanitized title
+        titles = dict()
+        changed = False
+        for dialog in dialogs:
+            name = dialog.name()
+            source = dialog.raw_title(users_dict)
+            entry = self.entries.get(name)
+            if entry is not None and entry['source'] == source:
+                titles[name] = entry['title']
+                continue
+            titles[name] = sanitize_title(source)
+            self.entries[name] = {'source': source, 'title': titles[name]}
+            changed = True
+        for name in list(self.entries.keys()):
+            if name not in titles:
+                del self.entries[name]
+                changed = True
+        if not changed and all('filename' in entry
+                               for entry in self.entries.values()):
+            return
+        # only a change of some title can change collisions
+        counts = dict()
+        for title in titles.values():
+            key = title.casefold()
+            counts[key] = counts.get(key, 0) + 1
+        for name, title in titles.items():
+            if counts[title.casefold()] > 1:
+                title = '%s (%s)' % (title, name)
+            self.entries[name]['filename'] = title + '.txt'
+        self.is_changed = True
+
+    def dump_filename(self, dialog):
+        return self.entries[dialog.name()]['filename']
+
+
 # assume that ids are integers
 class vk_messages_storage:
-    def __init__(self, storage_dir, dump_dir):
+    render_state_filename = 'render_state.json'
+    render_state_version = 2
+
+    def __init__(self, storage_dir, dump_dir, storage_format=None, tz=None):
         self.storage_dir = storage_dir
         self.dump_dir = dump_dir
+        # timezone of chatlogs, see create_timezone()
+        self.tz = TZ() if tz is None else tz
+        self.backend = create_storage_backend(storage_dir, storage_format)
+        self.search_index = vk_search_index(storage_dir,
+                                            type(self.backend).__name__)
+        self.titles = vk_dialog_titles(storage_dir)
+        # run_metrics of the account, see backup()
+        self.metrics = metrics
         self.last_sent_id = vk_message.no_id
         self.last_recv_id = vk_message.no_id
         self.dialogs = dict()
+        # dialog name -> what is written to the chatlog
+        self.render_state = dict()
+        # ids of dialogs with unsaved messages
+        self.dirty_dialogs = set()
+        # ids of dialogs saved since the metadata was committed
+        self.flushed_dialogs = set()
 
     # for internal use
-    def update_last_id(self, msg):
-        if msg.sent():
-            self.last_sent_id = max(self.last_sent_id, msg.id())
-        else:
-            self.last_recv_id = max(self.last_recv_id, msg.id())
+    def update_last_id(self, dialog):
+        self.last_sent_id = max(self.last_sent_id, dialog.last_sent_id)
+        self.last_recv_id = max(self.last_recv_id, dialog.last_recv_id)
 
-    # assume that adding message is not stored already
+    # a message that is added already is skipped
     def add_message(self, msg):
-        self.update_last_id(msg)
         dialog_id = msg.dialog_id()
         if dialog_id not in self.dialogs.keys():
-            self.dialogs[dialog_id] = vk_dialog(dialog_id)
-        self.dialogs[dialog_id].add_message(msg)
+            self.dialogs[dialog_id] = vk_dialog(dialog_id, self.backend)
+        dialog = self.dialogs[dialog_id]
+        if not dialog.add_message(msg):
+            return
+        self.update_last_id(dialog)
+        self.dirty_dialogs.add(dialog_id)
+        self.search_index.add_message(msg)
+        self.metrics.add('messages_added_total')
 
     def add_messages(self, messages):
         for msg in messages:
             self.add_message(msg)
 
+    # pass new messages to the backend; they are durable after sync() and
+    # the metadata is committed by save(), until then it is just stale for
+    # flushed dialogs
+    def flush(self):
+        if len(self.dirty_dialogs) == 0:
+            return
+        # dialogs loaded to check duplicates are not kept in memory
+        for dialog_id in self.dirty_dialogs:
+            self.dialogs[dialog_id].save()
+            self.dialogs[dialog_id].unload()
+        self.search_index.flush()
+        self.flushed_dialogs.update(self.dirty_dialogs)
+        self.dirty_dialogs = set()
+
+    # a durability barrier for all flushed messages, it is not cheap
+    def sync(self):
+        self.flush()
+        self.backend.sync()
+
+    # save only dialogs that got new messages since the last save
     def save(self):
         logging.info('Saving messages to storage...')
-        safe_mkdir(self.storage_dir)
-        for dialog in self.dialogs.values():
-            dialog.save(self.storage_dir)
-
-    def dump(self, users_dict):
+        self.sync()
+        logging.info('%d of %d dialogs changed', len(self.flushed_dialogs),
+                     len(self.dialogs))
+        flushed = [self.dialogs[dialog_id]
+                   for dialog_id in self.flushed_dialogs]
+        self.backend.commit(flushed)
+        self.search_index.commit(flushed)
+        self.flushed_dialogs = set()
+
+    # render only new messages when possible, see unrendered_messages();
+    # with jobs > 1 full renders go to a process pool, the largest dialogs
+    # first; all chatlogs are committed by one transaction, the render
+    # state follows them; assume that all messages are saved; with
+    # 'dialog_ids' other dialogs are not even checked
+    def dump(self, users_dict, jobs=1, dialog_ids=None):
         logging.info('Dumping messages log into files...')
         safe_mkdir(self.dump_dir)
-        for dialog in self.dialogs.values():
-            dialog.dump(self.dump_dir, users_dict)
+        self.load_render_state()
+        # chatlogs left by an interrupted run
+        tmp_suffix = '.txt' + file_transaction.tmp_suffix
+        for filename in os.listdir(self.dump_dir):
+            if filename.endswith(tmp_suffix):
+                os.remove(os.path.join(self.dump_dir, filename))
+        self.titles.load()
+        self.titles.update(self.dialogs.values(), users_dict)
+        self.rename_chatlogs()
+        self.titles.save()
+        if dialog_ids is None:
+            dialogs = list(self.dialogs.values())
+        else:
+            dialogs = [self.dialogs[dialog_id] for dialog_id in dialog_ids]
+        transaction = file_transaction()
+        full_render = []
+        # (dialog, fingerprint) pairs of written chatlogs
+        rendered = []
+        for dialog in dialogs:
+            entry = self.render_state.get(dialog.name())
+            dump_filename = self.titles.dump_filename(dialog)
+            fingerprint = dialog.render_fingerprint(users_dict, self.tz)
+            unrendered = self.unrendered_messages(
+                dialog, entry, dump_filename, fingerprint)
+            if unrendered is None:
+                full_render.append((dialog, fingerprint))
+                continue
+            if len(unrendered) == 0:
+                continue
+            dialog.dump_unrendered(self.dump_dir, users_dict, unrendered,
+                                   self.tz, transaction, dump_filename)
+            rendered.append((dialog, fingerprint))
+        append_cnt = len(rendered)
+
+        full_render.sort(key=lambda item: item[0].count, reverse=True)
+        try:
+            if jobs > 1 and len(full_render) > 1:
+                self.dump_parallel(full_render, users_dict, jobs,
+                                   transaction)
+            else:
+                for dialog, fingerprint in full_render:
+                    was_loaded = dialog.is_loaded()
+                    dialog.load()
+                    dialog.dump(self.dump_dir, users_dict, self.tz,
+                                transaction, self.titles.dump_filename(dialog))
+                    if not was_loaded:
+                        dialog.unload()
+        except BaseException:
+            transaction.abort()
+            raise
+        transaction.commit()
+        self.metrics.add('chatlogs_rendered_total', len(full_render))
+        self.metrics.add('chatlogs_appended_total', append_cnt)
+        rendered.extend(full_render)
+        for dialog, fingerprint in rendered:
+            self.update_render_state(dialog, users_dict, fingerprint)
+        logging.info('%d chatlogs rendered, %d appended, %d unchanged',
+                     len(full_render), append_cnt,
+                     len(dialogs) - len(full_render) - append_cnt)
+        self.save_render_state()
+
+    # for internal use; dialogs with unsaved messages are rendered here,
+    # others are read from the storage by the workers
+    # workers are not forked while other threads run (like other accounts
+    # of backup_accounts()): they may hold logging or rate limiter locks,
+    # a forked worker would inherit them locked; a fork server costs
+    # a second to start, so a lone thread still forks
+    def dump_parallel(self, full_render, users_dict, jobs, transaction):
+        initargs = (self.storage_dir, self.backend.format_name,
+                    self.dump_dir, users_dict, self.tz)
+        mp_context = None
+        if threading.active_count() > 1:
+            start_method = 'spawn'
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                start_method = 'forkserver'
+            mp_context = multiprocessing.get_context(start_method)
+        with ProcessPoolExecutor(max_workers=jobs,
+                                 initializer=render_worker_init,
+                                 initargs=initargs,
+                                 mp_context=mp_context) as pool:
+            futures = []
+            for dialog, _ in full_render:
+                dump_filename = self.titles.dump_filename(dialog)
+                if dialog.is_dirty():
+                    dialog.load()
+                    dialog.dump(self.dump_dir, users_dict, self.tz,
+                                transaction, dump_filename)
+                    continue
+                futures.append(pool.submit(render_worker_dump, dialog.id,
+                                           dialog.meta(), dump_filename))
+            for future in futures:
+                for tmp_filepath, filepath in future.result():
+                    transaction.add(tmp_filepath, filepath)
+
+    # for internal use; a chatlog of a renamed dialog is moved to its new
+    # filename (through a temporary one, as names may be swapped), so it
+    # is appended to or rendered again as if it was not renamed; the
+    # render state is saved at once to follow the files. A chatlog that
+    # several dialogs wrote (before titles collisions were resolved) is
+    # removed, they are rendered again.
+    def rename_chatlogs(self):
+        owners = dict()
+        for entry in self.render_state.values():
+            owners[entry['filename']] = owners.get(entry['filename'], 0) + 1
+        dump_filenames = set(entry['filename']
+                             for entry in self.titles.entries.values())
+        moves = []
+        for name, entry in self.render_state.items():
+            if name not in self.titles.entries:
+                continue
+            dump_filename = self.titles.entries[name]['filename']
+            if entry['filename'] == dump_filename:
+                continue
+            filepath = os.path.join(self.dump_dir, entry['filename'])
+            if not os.path.isfile(filepath):
+                continue
+            if owners[entry['filename']] == 1:
+                moves.append((filepath, entry, dump_filename))
+            elif entry['filename'] not in dump_filenames:
+                os.remove(filepath)
+        if len(moves) == 0:
+            return
+        tmp_suffix = '.txt' + file_transaction.tmp_suffix
+        for filepath, _, _ in moves:
+            os.replace(filepath, filepath + tmp_suffix)
+        for filepath, entry, dump_filename in moves:
+            logging.info('Renaming %s to %s', entry['filename'],
+                         dump_filename)
+            os.replace(filepath + tmp_suffix,
+                       os.path.join(self.dump_dir, dump_filename))
+            entry['filename'] = dump_filename
+        sync_dir(self.dump_dir)
+        self.save_render_state()
+
+    # for internal use
+    def update_render_state(self, dialog, users_dict, fingerprint):
+        dump_filename = self.titles.dump_filename(dialog)
+        dump_filepath = os.path.join(self.dump_dir, dump_filename)
+        self.render_state[dialog.name()] = {
+            'filename': dump_filename,
+            'size': os.path.getsize(dump_filepath),
+            'position': dialog.position(),
+            'count': dialog.count,
+            'last_date': dialog.last_date,
+            'fingerprint': fingerprint,
+        }
+
+    # for internal use; return messages stored since the chatlog was
+    # rendered or None when the chatlog must be re-rendered
+    def unrendered_messages(self, dialog, entry, dump_filename, fingerprint):
+        if entry is None or dialog.is_dirty():
+            return None
+        if entry['fingerprint'] != fingerprint or \
+                entry['filename'] != dump_filename:
+            return None
+        # the chatlog was changed or removed by someone else
+        dump_filepath = os.path.join(self.dump_dir, dump_filename)
+        if not os.path.isfile(dump_filepath) or \
+                os.path.getsize(dump_filepath) != entry['size']:
+            return None
+        position = dialog.position()
+        if position == entry['position'] and dialog.count == entry['count']:
+            return []
+        if position < entry['position']:
+            return None
+        unrendered = dialog.read_tail(entry['position'])
+        if entry['count'] + len(unrendered) != dialog.count:
+            return None
+        # new messages must go after the rendered ones
+        if any(msg.date() < entry['last_date'] for msg in unrendered):
+            return None
+        return unrendered
+
+    # for internal use
+    def load_render_state(self):
+        self.render_state = dict()
+        filepath = os.path.join(self.storage_dir, self.render_state_filename)
+        if not os.path.isfile(filepath):
+            return
+        with open(filepath, 'r', encoding='utf-8') as f:
+            try:
+                data = json.load(f)
+            except ValueError:
+                logging.warning('Cannot parse %s, rendering all chatlogs',
+                                filepath)
+                return
+        if data.get('version') != self.render_state_version:
+            return
+        # chatlogs in other directory or from other backend are not known
+        if data.get('dump_dir') != os.path.abspath(self.dump_dir) or \
+                data.get('backend') != type(self.backend).__name__:
+            return
+        self.render_state = data['dialogs']
+
+    # for internal use
+    def save_render_state(self):
+        safe_mkdir(self.storage_dir)
+        filepath = os.path.join(self.storage_dir, self.render_state_filename)
+        data = {
+            'version': self.render_state_version,
+            'dump_dir': os.path.abspath(self.dump_dir),
+            'backend': type(self.backend).__name__,
+            'dialogs': self.render_state,
+        }
+        transaction = file_transaction()
+        with transaction.open(filepath, 'w', encoding='utf-8') as f:
+            print_json(data, file=f)
+        transaction.commit()
 
     def load(self):
         if not os.path.isdir(self.storage_dir):
             return
         logging.info('Loading messages from storage...')
-        for filename in os.listdir(self.storage_dir):
-            filepath = os.path.join(self.storage_dir, filename)
-            dialog_id = vk_dialog.filepath_to_id(filepath)
-            # skip files that not matching vk_dialog naming scheme
-            if dialog_id is None:
-                continue
-            if not os.path.isfile(filepath):
-                raise NameError('vk_messages_storage.load: '
-                                '%s is not regular file' % filepath)
-            with open(filepath, 'r') as f:
-                for raw_msg in json.load(f):
-                    msg = vk_message(raw_msg, from_cache=True)
-                    self.add_message(msg)
+        rebuilt = []
+        for dialog_id, meta in self.backend.load_dialogs():
+            dialog = vk_dialog(dialog_id, self.backend)
+            if meta is not None:
+                dialog.set_meta(meta)
+            else:
+                # read the messages once to rebuild the metadata
+                dialog.load()
+                dialog.unload()
+                rebuilt.append(dialog)
+            if dialog.is_dirty():
+                self.dirty_dialogs.add(dialog_id)
+            self.dialogs[dialog_id] = dialog
+            self.update_last_id(dialog)
+        if len(rebuilt) > 0:
+            logging.info('Metadata rebuilt for %d dialogs', len(rebuilt))
+            self.backend.commit(rebuilt)
+        self.search_index.sync(self.dialogs.values())
+
+    def close(self):
+        self.backend.close()
+        self.search_index.close()
 
     def last_id(self, sent):
         if sent:
@@ -436,12 +2467,38 @@ class vk_messages_storage:
         return users_ids
 
 
+# state of a chatlog rendering process, see vk_messages_storage.dump()
+render_worker = dict()
+
+
+def render_worker_init(storage_dir, storage_format, dump_dir, users_dict,
+                       tz):
+    render_worker['backend'] = create_storage_backend(storage_dir,
+                                                      storage_format)
+    render_worker['dump_dir'] = dump_dir
+    render_worker['users_dict'] = users_dict
+    render_worker['tz'] = tz
+
+
+# return files to commit, see file_transaction.add()
+def render_worker_dump(dialog_id, meta, dump_filename):
+    dialog = vk_dialog(dialog_id, render_worker['backend'])
+    dialog.set_meta(meta)
+    dialog.load()
+    transaction = file_transaction()
+    dialog.dump(render_worker['dump_dir'], render_worker['users_dict'],
+                render_worker['tz'], transaction, dump_filename)
+    return transaction.renames
+
+
 class vk_user:
     no_id = -1
 
-    def __init__(self, data, from_cache=False):
+    # 'fetched_at' is a unix time of the download
+    def __init__(self, data, from_cache=False, fetched_at=None):
         self.data = data
         self.from_cache = from_cache
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
 
     def __str__(self):
         return '%s %s' % (self.data['first_name'], self.data['last_name'])
@@ -455,6 +2512,7 @@ class vk_user:
     def is_from_cache(self):
         return self.from_cache
 
+    # old-style storage: one file per user
     @staticmethod
     def filepath_to_id(filepath):
         filename = os.path.basename(filepath)
@@ -465,29 +2523,66 @@ class vk_user:
             return None
 
 
+# all users are kept in one users.json file that is rewritten only when
+# some user is added or refreshed
 class vk_users_storage:
+    filename = 'users.json'
+    version = 1
+
     def __init__(self, storage_dir):
         self.storage_dir = storage_dir
-        self.users = []
+        # id -> vk_user
+        self.users = dict()
+        self.is_changed = False
+        self.lock = threading.Lock()
 
-    # assume that users not added already
+    # users that are stored already are replaced
     def add_users(self, users):
-        self.users.extend(users)
+        with self.lock:
+            for user in users:
+                self.users[user.id()] = user
+            if len(users) > 0:
+                self.is_changed = True
 
     def save(self):
+        if not self.is_changed:
+            return
         logging.info('Saving users to storage...')
         safe_mkdir(self.storage_dir)
-        for user in self.users:
-            data = user.raw()
-            filename = 'user_%d.json' % data['id']
-            filepath = os.path.join(self.storage_dir, filename)
-            with open(filepath, 'w') as f:
-                print_json(data, file=f)
+        filepath = os.path.join(self.storage_dir, self.filename)
+        with self.lock:
+            data = {
+                'version': self.version,
+                'users': [{'data': user.raw(), 'fetched_at': user.fetched_at}
+                          for _, user in sorted(self.users.items())],
+            }
+            self.is_changed = False
+        transaction = file_transaction()
+        with transaction.open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, sort_keys=True)
+        transaction.commit()
 
     def load(self):
         if not os.path.isdir(self.storage_dir):
             return
         logging.info('Loading users from storage...')
+        filepath = os.path.join(self.storage_dir, self.filename)
+        if not os.path.isfile(filepath):
+            self.load_legacy()
+            return
+        with open(filepath, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != self.version:
+            raise NameError('vk_users_storage.load: '
+                            'unsupported version of %s' % filepath)
+        for entry in data['users']:
+            user = vk_user(entry['data'], from_cache=True,
+                           fetched_at=entry['fetched_at'])
+            self.users[user.id()] = user
+
+    # for internal use; read old-style user_<id>.json files, they are
+    # merged into users.json on the next save()
+    def load_legacy(self):
         for filename in os.listdir(self.storage_dir):
             filepath = os.path.join(self.storage_dir, filename)
             user_id = vk_user.filepath_to_id(filepath)
@@ -498,38 +2593,570 @@ class vk_users_storage:
                 raise NameError('vk_users_storage.load: '
                                 '%s is not regular file' % filepath)
             with open(filepath, 'r') as f:
-                user = vk_user(json.load(f), from_cache=True)
-            self.users.append(user)
+                user = vk_user(json.load(f), from_cache=True,
+                               fetched_at=os.path.getmtime(filepath))
+            self.users[user.id()] = user
+            self.is_changed = True
 
     def ids(self):
-        users_ids = set()
-        for user in self.users:
-            users_ids.add(user.id())
-        return users_ids
+        with self.lock:
+            return set(self.users.keys())
+
+    # ids of users downloaded more than 'ttl' seconds ago, the oldest
+    # first, not more than 'limit'
+    def stale_ids(self, ttl, limit):
+        deadline = time.time() - ttl
+        with self.lock:
+            stale = [user for user in self.users.values()
+                     if user.fetched_at < deadline]
+        stale.sort(key=lambda user: user.fetched_at)
+        return [user.id() for user in stale[:limit]]
 
     def users_dict(self, my_id):
-        res = dict()
-        for user in self.users:
-            res[user.id()] = user
+        res = dict(self.users)
         res['me'] = res[my_id]
         return res
 
 
+# users downloaded by this process for all accounts of a multi-account
+# backup, so a participant of several accounts' chats is requested once;
+# ids that another account is downloading right now are waited for
+class vk_users_cache:
+    def __init__(self):
+        # id -> vk_user
+        self.users = dict()
+        # ids being downloaded
+        self.pending = set()
+        self.cond = threading.Condition()
+
+    # for internal use
+    def is_fresh(self, user_id, deadline):
+        return user_id in self.users and \
+            self.users[user_id].fetched_at >= deadline
+
+    # return (cached users, ids to download); users downloaded earlier
+    # than 'ttl' seconds ago are downloaded again, as users_to_refresh()
+    # wants; the caller must pass the ids to release() when the download
+    # is over, successful or not
+    def claim(self, users_ids, ttl):
+        with self.cond:
+            deadline = time.time() - ttl
+            while any(user_id in self.pending and
+                      not self.is_fresh(user_id, deadline)
+                      for user_id in users_ids):
+                self.cond.wait()
+            cached = [self.users[user_id] for user_id in users_ids
+                      if self.is_fresh(user_id, deadline)]
+            missing = [user_id for user_id in users_ids
+                       if not self.is_fresh(user_id, deadline)]
+            self.pending.update(missing)
+            return cached, missing
+
+    def release(self, users_ids, users):
+        with self.cond:
+            for user in users:
+                self.users[user.id()] = user
+            self.pending.difference_update(users_ids)
+            self.cond.notify_all()
+
+
+# progress of interrupted downloads: for every stream (sent / received
+# messages) the download parameters ('after_id'), the offset of the next
+# page and the range of ids that are already in the storage; it is
+# written every 'save_interval' seconds after the storage is synced (see
+# store_page()), so it may lag behind but never runs ahead of the storage;
+# a started stream is written at once: pages are downloaded from newer to
+# older ones, the storage alone does not tell where to continue
+class vk_download_checkpoint:
+    filename = 'checkpoint.json'
+    save_interval = 5
+
+    def __init__(self, storage_dir):
+        self.storage_dir = storage_dir
+        self.streams = dict()
+        self.is_changed = False
+        self.has_new_stream = False
+        self.saved_at = time.monotonic()
+
+    @staticmethod
+    def stream_name(sent):
+        return 'sent' if sent else 'recv'
+
+    def load(self):
+        filepath = os.path.join(self.storage_dir, self.filename)
+        if not os.path.isfile(filepath):
+            return
+        with open(filepath, 'r') as f:
+            self.streams = json.load(f)
+
+    def get(self, sent):
+        return self.streams.get(self.stream_name(sent))
+
+    # 'progress' is None when the stream is finished
+    def set(self, sent, progress):
+        name = self.stream_name(sent)
+        if progress is None:
+            if name not in self.streams:
+                return
+            del self.streams[name]
+        else:
+            if name not in self.streams:
+                self.has_new_stream = True
+            self.streams[name] = progress
+        self.is_changed = True
+
+    def is_due(self):
+        if self.has_new_stream:
+            return True
+        return self.is_changed and \
+            time.monotonic() - self.saved_at >= self.save_interval
+
+    def save(self):
+        if not self.is_changed:
+            return
+        self.is_changed = False
+        self.has_new_stream = False
+        self.saved_at = time.monotonic()
+        filepath = os.path.join(self.storage_dir, self.filename)
+        if len(self.streams) == 0:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            return
+        safe_mkdir(self.storage_dir)
+        transaction = file_transaction()
+        with transaction.open(filepath, 'w') as f:
+            print_json(self.streams, file=f)
+        transaction.commit()
+
+
+# Attached files are kept by content: <storage>/attachments/ab/abcdef...
+# is named by its sha256, so a file attached in several chats is stored
+# once. index.jsonl maps attachment keys (like photo<owner_id>_<id>) to
+# the files and is appended after every download, that makes an
+# interrupted download resumable; failed ones are appended too and retried
+# by the next run. scan.json keeps the backend positions of dialogs that
+# are scanned for attachments already, like the render state does.
+class vk_attachments_storage:
+    dirname = 'attachments'
+    index_filename = 'index.jsonl'
+    scan_filename = 'scan.json'
+    scan_version = 1
+    # the largest available size of photos and stickers
+    photo_sizes = ['photo_2560', 'photo_1280', 'photo_807', 'photo_604',
+                   'photo_352', 'photo_256', 'photo_130', 'photo_128',
+                   'photo_75', 'photo_64']
+
+    # 'backend_name' is the class name of the storage backend, positions
+    # of other backends are meaningless
+    def __init__(self, storage_dir, backend_name):
+        self.dir = os.path.join(storage_dir, self.dirname)
+        self.backend_name = backend_name
+        # key -> {'sha256', 'size'}
+        self.files = dict()
+        # key -> url of failed downloads
+        self.failed = dict()
+        # dialog name -> [position, count]
+        self.scanned = dict()
+        # files written since the last save()
+        self.written = set()
+        self.lock = threading.Lock()
+
+    # (key, url) of files attached to a raw message and its forwarded
+    # messages; videos, links, wall posts and so on have no file
+    @staticmethod
+    def message_files(msg):
+        res = []
+        for attachment in msg.get('attachments', ()):
+            kind = attachment.get('type')
+            data = attachment.get(kind)
+            if not isinstance(data, dict):
+                continue
+            url = None
+            if kind in ('doc', 'audio'):
+                url = data.get('url')
+            elif kind in ('photo', 'sticker'):
+                for size in vk_attachments_storage.photo_sizes:
+                    if size in data:
+                        url = data[size]
+                        break
+            if not url:
+                continue
+            key = '%s%s_%s' % (kind, data.get('owner_id', 0), data.get('id'))
+            res.append((key, url))
+        for fwd_msg in msg.get('fwd_messages', ()):
+            res.extend(vk_attachments_storage.message_files(fwd_msg))
+        return res
+
+    def blob_path(self, sha256):
+        return os.path.join(self.dir, sha256[:2], sha256)
+
+    def load(self):
+        filepath = os.path.join(self.dir, self.index_filename)
+        if os.path.isfile(filepath):
+            with open(filepath, 'rb') as f:
+                for line in f:
+                    # a line cut by an interrupted run, the next run
+                    # appends after it
+                    try:
+                        entry = json_record(line)
+                    except ValueError:
+                        logging.warning('Skipping damaged record in %s',
+                                        filepath)
+                        continue
+                    if 'error' in entry:
+                        self.failed[entry['key']] = entry['url']
+                        continue
+                    self.files[entry['key']] = {
+                        'sha256': entry['sha256'],
+                        'size': entry['size'],
+                    }
+                    self.failed.pop(entry['key'], None)
+        filepath = os.path.join(self.dir, self.scan_filename)
+        if os.path.isfile(filepath):
+            with open(filepath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == self.scan_version and \
+                    data.get('backend') == self.backend_name:
+                self.scanned = data['dialogs']
+        # downloads left by an interrupted run
+        if os.path.isdir(self.dir):
+            for filename in os.listdir(self.dir):
+                if filename.endswith('.part'):
+                    os.remove(os.path.join(self.dir, filename))
+
+    # the file is downloaded and its blob is in place
+    def has(self, key):
+        entry = self.files.get(key)
+        if entry is None:
+            return False
+        filepath = self.blob_path(entry['sha256'])
+        return os.path.isfile(filepath) and \
+            os.path.getsize(filepath) == entry['size']
+
+    # (key, url) of files to download: attached to messages stored since
+    # the last scan or failed earlier
+    def missing_files(self, dialogs):
+        res = dict(self.failed)
+        scanned_cnt = 0
+        for dialog in dialogs:
+            entry = self.scanned.get(dialog.name())
+            messages = None
+            if entry is not None:
+                messages = dialog.read_tail_since(*entry)
+            if messages is None:
+                was_loaded = dialog.is_loaded()
+                messages = dialog.get_messages()
+                if not was_loaded:
+                    dialog.unload()
+            if len(messages) > 0:
+                scanned_cnt += 1
+            for msg in messages:
+                for key, url in self.message_files(msg.raw()):
+                    res[key] = url
+            if not dialog.is_dirty():
+                self.scanned[dialog.name()] = [dialog.position(),
+                                               dialog.count]
+        if scanned_cnt > 0:
+            logging.info('%d dialogs scanned for attachments', scanned_cnt)
+        return [(key, url) for key, url in res.items() if not self.has(key)]
+
+    # for internal use
+    def append_index(self, entry):
+        with self.lock:
+            safe_mkdir(self.dir)
+            filepath = os.path.join(self.dir, self.index_filename)
+            with open(filepath, 'a', encoding='utf-8') as f:
+                f.write(json_line(entry))
+            self.written.add(filepath)
+
+    # 'tmp_filepath' is a downloaded file, moved into the blob store
+    def add(self, key, url, tmp_filepath, sha256, size):
+        filepath = self.blob_path(sha256)
+        with self.lock:
+            if os.path.isfile(filepath) and \
+                    os.path.getsize(filepath) == size:
+                os.remove(tmp_filepath)
+            else:
+                safe_mkdir(os.path.dirname(filepath))
+                os.replace(tmp_filepath, filepath)
+                self.written.add(filepath)
+            self.files[key] = {'sha256': sha256, 'size': size}
+            self.failed.pop(key, None)
+        self.append_index({'key': key, 'url': url, 'sha256': sha256,
+                           'size': size})
+
+    def add_failed(self, key, url, error):
+        with self.lock:
+            self.failed[key] = url
+        self.append_index({'key': key, 'url': url, 'error': error})
+
+    # downloaded files and the index are synced with scan.json
+    def save(self):
+        safe_mkdir(self.dir)
+        filepath = os.path.join(self.dir, self.scan_filename)
+        data = {
+            'version': self.scan_version,
+            'backend': self.backend_name,
+            'dialogs': self.scanned,
+        }
+        transaction = file_transaction()
+        with self.lock:
+            for written_filepath in self.written:
+                transaction.add_synced(written_filepath)
+            self.written = set()
+        with transaction.open(filepath, 'w', encoding='utf-8') as f:
+            print_json(data, file=f)
+        transaction.commit()
+
+
+# Dialogs for cold storage: every dialog is read from the storage on its
+# own and cut into chunks of about 'chunk_size' bytes of uncompressed data,
+# oldest messages first, so chunks before new messages keep their contents
+# between runs. A chunk is written (compressed, or as an HTML page) as soon
+# as it is complete. manifest.json lists the chunks with sha256 of their
+# contents and files; a chunk with the same contents is not written again,
+# and a dialog with the same backend position is not even read.
+class vk_exporter:
+    manifest_filename = 'manifest.json'
+    manifest_version = 1
+    # format -> chunk file extension
+    extensions = {
+        'jsonl.gz': '.jsonl.gz',
+        'jsonl.zst': '.jsonl.zst',
+        'html': '.html',
+    }
+    default_chunk_size = 16 * 2**20
+    zstd_level = 10
+
+    def __init__(self, export_dir, export_format, backend_name,
+                 chunk_size=None):
+        if export_format not in self.extensions:
+            raise NameError('vk_exporter: unknown format: %s' % export_format)
+        if export_format == 'jsonl.zst' and zstandard is None:
+            raise NameError('vk_exporter: jsonl.zst export needs the '
+                            'zstandard module')
+        self.dir = export_dir
+        self.format = export_format
+        self.backend_name = backend_name
+        self.chunk_size = chunk_size or self.default_chunk_size
+        # chunk path relative to 'dir' -> {'sha256' (of contents),
+        # 'file_sha256', 'size', 'messages', 'first_date', 'last_date'}
+        self.chunks = dict()
+        # dialog name -> {'position', 'count', 'fingerprint', 'chunks'}
+        self.dialogs = dict()
+        self.written_cnt = 0
+        self.unchanged_cnt = 0
+
+    # chunks of another format, chunk size or backend are not reused
+    def load(self):
+        filepath = os.path.join(self.dir, self.manifest_filename)
+        if not os.path.isfile(filepath):
+            return
+        with open(filepath, 'r', encoding='utf-8') as f:
+            try:
+                data = json.load(f)
+            except ValueError:
+                logging.warning('Cannot parse %s, exporting all dialogs',
+                                filepath)
+                return
+        if data.get('version') != self.manifest_version or \
+                data.get('format') != self.format or \
+                data.get('chunk_size') != self.chunk_size or \
+                data.get('backend') != self.backend_name:
+            return
+        self.chunks = data['chunks']
+        self.dialogs = data['dialogs']
+
+    def save(self):
+        data = {
+            'version': self.manifest_version,
+            'format': self.format,
+            'chunk_size': self.chunk_size,
+            'backend': self.backend_name,
+            'dialogs': self.dialogs,
+            'chunks': self.chunks,
+        }
+        transaction = file_transaction()
+        with transaction.open(os.path.join(self.dir, self.manifest_filename),
+                              'w', encoding='utf-8') as f:
+            print_json(data, file=f)
+        transaction.commit()
+
+    # all chunks of dialogs in 'storage' are committed by one transaction,
+    # the manifest follows them
+    def export(self, storage, users_dict, tz=None):
+        logging.info('Exporting dialogs to %s...', self.dir)
+        safe_mkdir(self.dir)
+        transaction = file_transaction()
+        # chunks that are not in the export anymore
+        stale = set(self.chunks.keys())
+        try:
+            for name in sorted(self.dialogs.keys()):
+                if vk_dialog.name_to_id(name) not in storage.dialogs:
+                    del self.dialogs[name]
+            titles = []
+            for dialog_id in sorted(storage.dialogs.keys()):
+                dialog = storage.dialogs[dialog_id]
+                titles.append((dialog.name(), dialog.title(users_dict)))
+                stale.difference_update(
+                    self.export_dialog(dialog, users_dict, tz, transaction))
+            if self.format == 'html':
+                self.write_index(titles, transaction)
+        except BaseException:
+            transaction.abort()
+            raise
+        transaction.commit()
+        for path in stale:
+            del self.chunks[path]
+            filepath = os.path.join(self.dir, path)
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+        self.save()
+        logging.info('%d chunks written, %d unchanged, %d removed',
+                     self.written_cnt, self.unchanged_cnt, len(stale))
+
+    # for internal use; return paths of the dialog chunks
+    def export_dialog(self, dialog, users_dict, tz, transaction):
+        name = dialog.name()
+        fingerprint = None
+        if self.format == 'html':
+            fingerprint = dialog.render_fingerprint(users_dict, tz)
+        entry = self.dialogs.get(name)
+        if entry is not None and not dialog.is_dirty() and \
+                entry['position'] == dialog.position() and \
+                entry['count'] == dialog.count and \
+                entry['fingerprint'] == fingerprint and \
+                all(os.path.isfile(os.path.join(self.dir, path))
+                    for path in entry['chunks']):
+            self.unchanged_cnt += len(entry['chunks'])
+            return entry['chunks']
+
+        safe_mkdir(os.path.join(self.dir, name))
+        was_loaded = dialog.is_loaded()
+        paths = []
+        for index, lines, messages, has_next in self.dialog_chunks(
+                dialog, users_dict, tz):
+            path = '%s/%05d%s' % (name, index, self.extensions[self.format])
+            if self.format == 'html':
+                lines = self.html_page(dialog.title(users_dict), index,
+                                       has_next, lines)
+            self.write_chunk(path, lines, messages, transaction)
+            paths.append(path)
+        if not was_loaded:
+            dialog.unload()
+        self.dialogs[name] = {
+            'position': dialog.position(),
+            'count': dialog.count,
+            'fingerprint': fingerprint,
+            'chunks': paths,
+        }
+        return paths
+
+    # for internal use; yield (index, encoded lines, messages, whether a
+    # chunk follows) of chunks; a chunk is yielded when the next one starts,
+    # so it is known whether it is the last one
+    def dialog_chunks(self, dialog, users_dict, tz):
+        if self.format == 'html':
+            formatter = vk_message_formatter(users_dict, tz)
+
+            def encode(msg):
+                text = html.escape(msg.format(users_dict, formatter))
+                return (text + '\n').encode('utf-8')
+        else:
+            def encode(msg):
+                return msg.data + b'\n'
+        index = 0
+        lines = []
+        messages = []
+        size = 0
+        for msg in dialog.get_messages():
+            if size >= self.chunk_size:
+                yield index, lines, messages, True
+                index += 1
+                lines = []
+                messages = []
+                size = 0
+            line = encode(msg)
+            lines.append(line)
+            messages.append(msg)
+            size += len(line)
+        if len(lines) > 0:
+            yield index, lines, messages, False
+
+    # for internal use; the chunk is compressed only when its contents
+    # changed
+    def write_chunk(self, path, lines, messages, transaction):
+        content_sha256 = hashlib.sha256()
+        for line in lines:
+            content_sha256.update(line)
+        content_sha256 = content_sha256.hexdigest()
+        entry = self.chunks.get(path)
+        filepath = os.path.join(self.dir, path)
+        if entry is not None and entry['sha256'] == content_sha256 and \
+                os.path.isfile(filepath) and \
+                os.path.getsize(filepath) == entry['size']:
+            self.unchanged_cnt += 1
+            return
+        data = b''.join(lines)
+        if self.format == 'jsonl.gz':
+            # no timestamp in the header, the same contents give the same
+            # file
+            data = gzip.compress(data, mtime=0)
+        elif self.format == 'jsonl.zst':
+            data = zstandard.ZstdCompressor(level=self.zstd_level).compress(
+                data)
+        with transaction.open(filepath, 'wb') as f:
+            f.write(data)
+        self.chunks[path] = {
+            'sha256': content_sha256,
+            'file_sha256': hashlib.sha256(data).hexdigest(),
+            'size': len(data),
+            'messages': len(messages),
+            'first_date': messages[0].date(),
+            'last_date': messages[-1].date(),
+        }
+        self.written_cnt += 1
+
+    # for internal use; a page with links to the neighbour ones
+    def html_page(self, title, index, has_next, lines):
+        ext = self.extensions['html']
+        links = ['<a href="../index.html">all dialogs</a>']
+        if index > 0:
+            links.append('<a href="%05d%s">previous</a>' % (index - 1, ext))
+        if has_next:
+            links.append('<a href="%05d%s">next</a>' % (index + 1, ext))
+        nav = ('<p>%s</p>\n' % ' | '.join(links)).encode('utf-8')
+        head = ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+                '<title>%s, page %d</title>\n</head>\n<body>\n'
+                '<h1>%s</h1>\n' % (html.escape(title), index + 1,
+                                   html.escape(title))).encode('utf-8')
+        return [head, nav, b'<pre>\n'] + lines + \
+            [b'</pre>\n', nav, b'</body>\n</html>\n']
+
+    # for internal use; 'titles' is a list of (dialog name, title)
+    def write_index(self, titles, transaction):
+        ext = self.extensions['html']
+        filepath = os.path.join(self.dir, 'index.html')
+        with transaction.open(filepath, 'w', encoding='utf-8') as f:
+            f.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">'
+                    '\n<title>Dialogs</title>\n</head>\n<body>\n<ul>\n')
+            for name, title in sorted(titles, key=lambda item: item[1]):
+                f.write('<li><a href="%s/00000%s">%s</a></li>\n' % (
+                    name, ext, html.escape(title)))
+            f.write('</ul>\n</body>\n</html>\n')
+
+
 # Functions that touch certain VK API methods
 # ===========================================
 
-# get all messages from the most fresher than 'after_id'
-def get_vk_messages(vk, sent, after_id):
-    if sent:
-        logging.info('Downloading sent messages...')
-    else:
-        logging.info('Downloading received messages...')
-    res_messages = []
-    ids = set()
-    msg_per_request = 200
+msg_per_request = 200
+
+
+# for internal use
+def messages_get_params(sent, after_id, offset=0):
     params = {
         'out': int(sent),
-        'offset': 0,
+        'offset': offset,
         'count': msg_per_request,
         'time_offset': 0,
         'preview_length': 0,
@@ -537,29 +3164,92 @@ def get_vk_messages(vk, sent, after_id):
     # don't get messages before 'after_id' (inclusive)
     if after_id != vk_message.no_id:
         params['last_message_id'] = after_id
+    return params
+
+
+# offset to continue an interrupted download described by 'resume'
+# (see vk_download_checkpoint): messages that came after the checkpoint
+# shift the old offset, they are counted but not downloaded
+def find_resume_offset(vk, sent, resume):
+    shift = 0
+    offset = 0
     while True:
-        logging.info('[get_vk_messages] Downloading from offset %s...',
-                     params['offset'])
-        response = vk.do_request('messages.get', params)
-        messages = [vk_message(msg) for msg in response['items']]
-        # stop when empty list received
-        if len(messages) == 0:
+        params = messages_get_params(sent, resume['after_id'], offset)
+        items = vk.do_request('messages.get', params)['items']
+        newer = [msg for msg in items if msg['id'] > resume['max_id']]
+        shift += len(newer)
+        if len(items) == 0 or len(newer) < len(items):
             break
-        for msg in messages:
-            if msg.id() not in ids:
-                res_messages.append(msg)
-                ids.add(msg.id())
-        params['offset'] += msg_per_request
-    return res_messages
+        offset += msg_per_request
+    # one page back in case some messages were deleted since then
+    return max(0, resume['offset'] + shift - msg_per_request)
 
 
+# get all messages from the most fresher than 'after_id';
+# yield (next offset, page) pairs (from newer to older pages);
+# with 'resume' continue an interrupted download and skip messages it
+# already got
+def get_vk_messages(vk, sent, after_id, resume=None):
+    if sent:
+        logging.info('Downloading sent messages...')
+    else:
+        logging.info('Downloading received messages...')
+    # ids of the previous page
+    ids = set()
+    params = messages_get_params(sent, after_id)
+    if resume is not None:
+        params['offset'] = find_resume_offset(vk, sent, resume)
+        logging.info('[get_vk_messages] Resuming from offset %s...',
+                     params['offset'])
+    # several pages per request when 'execute' is used
+    pages_per_request = vk.max_execute_calls if vk.use_execute else 1
+    finished = False
+    while not finished:
+        logging.info('[get_vk_messages] Downloading from offset %s...',
+                     params['offset'])
+        params_list = []
+        for i in range(pages_per_request):
+            page_params = params.copy()
+            page_params['offset'] += i * msg_per_request
+            params_list.append(page_params)
+        responses = vk.do_requests('messages.get', params_list)
+        for response in responses:
+            messages = [vk_message(msg) for msg in response['items']]
+            # stop when empty list received
+            if len(messages) == 0:
+                finished = True
+                break
+            # pages overlap when new messages arrive during the download
+            page = [msg for msg in messages if msg.id() not in ids]
+            ids = set(msg.id() for msg in messages)
+            if resume is not None:
+                page = [msg for msg in page if msg.id() < resume['min_id']]
+            params['offset'] += msg_per_request
+            yield params['offset'], page
+
+
+# users downloaded by other accounts (see vk_api.users_cache) are not
+# requested again
 def get_vk_users(vk, users_ids):
+    if vk.users_cache is None:
+        return download_vk_users(vk, users_ids)
+    cached, missing = vk.users_cache.claim(users_ids, vk.users_ttl)
+    users = []
+    try:
+        users = download_vk_users(vk, missing)
+    finally:
+        vk.users_cache.release(missing, users)
+    return cached + users
+
+
+# for internal use
+def download_vk_users(vk, users_ids):
     if len(users_ids) == 0:
         return []
 
     logging.info('Downloading users (chats\' participants)...')
 
-    chunksize = 20
+    chunksize = vk.users_batch_size
     chunks_cnt = (len(users_ids) + chunksize - 1) // chunksize
 
     def chunk_start(i):
@@ -568,21 +3258,353 @@ def get_vk_users(vk, users_ids):
     def chunk_end(i):
         return min((i+1) * chunksize, len(users_ids))
 
-    res_users = []
+    params_list = []
     for i in range(0, chunks_cnt):
-        logging.info('[get_vk_users] Downloading chunk %d / %d', i, chunks_cnt)
         users_ids_chunk = users_ids[chunk_start(i):chunk_end(i)]
         users_ids_str = ','.join([str(user_id) for user_id in users_ids_chunk])
-        params = {
+        params_list.append({
             'user_ids': users_ids_str,
             'fields': [],
             'name_case': 'nom',
-        }
-        response = vk.do_request('users.get', params)
+        })
+    logging.info('[get_vk_users] Downloading %d chunks', chunks_cnt)
+    res_users = []
+    for response in vk.do_requests('users.get', params_list):
         res_users.extend([vk_user(user) for user in response])
+    vk.metrics.add('users_downloaded_total', len(res_users))
     return res_users
 
 
+# waits for new messages on the Long Poll server of messages, see
+# https://vk.com/dev/using_longpoll
+class vk_long_poll:
+    # seconds the server holds a request without events
+    wait = 25
+    # event code of a new message
+    new_message_event = 4
+
+    def __init__(self, vk):
+        self.vk = vk
+        self.url = None
+        self.key = None
+        self.ts = None
+
+    # vk_api_error is raised when the long poll is not available
+    def connect(self):
+        response = self.vk.do_request('messages.getLongPollServer',
+                                      {'need_pts': 0})
+        server = response['server']
+        if '://' not in server:
+            server = 'https://' + server
+        self.url = server
+        self.key = response['key']
+        self.ts = response['ts']
+
+    # return True when new messages come, False after 'wait' seconds
+    # without them; network and server errors are raised. Messages that
+    # came before a (re)connection are not reported, so it returns True
+    # right after one.
+    def wait_messages(self):
+        if self.key is None:
+            self.connect()
+            return True
+        params = {
+            'act': 'a_check',
+            'key': self.key,
+            'ts': self.ts,
+            'wait': self.wait,
+            'mode': 0,
+        }
+        r = self.vk.session.get(self.url, params=params,
+                                timeout=self.wait + 10)
+        r.raise_for_status()
+        response = r.json()
+        failed = response.get('failed')
+        if failed == 1:
+            # events are lost, the storage does not care
+            self.ts = response['ts']
+            return True
+        if failed is not None:
+            # the key is expired or the server lost our data
+            self.key = None
+            return True
+        self.ts = response['ts']
+        return any(update[0] == self.new_message_event
+                   for update in response.get('updates', ()))
+
+
+# Download pipeline
+# =================
+
+# downloads users while messages are being downloaded: ids are collected
+# from message pages and are requested as soon as a full chunk is ready;
+# 'refresh_ids' (known users to download again) fill the chunks too
+class users_resolver:
+    def __init__(self, vk, users_storage, refresh_ids=()):
+        self.vk = vk
+        self.users_storage = users_storage
+        self.known_ids = users_storage.ids()
+        self.chunksize = vk.users_batch_size
+        self.refresh_ids = list(refresh_ids)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(
+            target=self.run, daemon=True,
+            name=threading.current_thread().name + '_users')
+        self.error = None
+        self.aborted = False
+
+    def start(self):
+        self.thread.start()
+
+    def add_messages(self, messages):
+        users_ids = set()
+        for msg in messages:
+            users_ids.update(msg.participants())
+        self.queue.put(users_ids)
+
+    # download remaining ids and wait for the thread
+    def finish(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    # stop the thread after a failed download: remaining ids are not
+    # downloaded, an error of the thread is dropped for the original one
+    def abort(self):
+        self.aborted = True
+        self.queue.put(None)
+        self.thread.join()
+
+    # for internal use
+    def run(self):
+        pending = self.refresh_ids
+        done = False
+        try:
+            while not done:
+                users_ids = self.queue.get()
+                if users_ids is None:
+                    done = True
+                else:
+                    for user_id in users_ids - self.known_ids:
+                        self.known_ids.add(user_id)
+                        pending.append(user_id)
+                while not self.aborted and \
+                        (len(pending) >= self.chunksize or
+                         (done and len(pending) > 0)):
+                    chunk = pending[:self.chunksize]
+                    pending = pending[self.chunksize:]
+                    self.users_storage.add_users(get_vk_users(self.vk, chunk))
+        except Exception as e:
+            self.error = e
+
+
+# users that are mentioned in the storage, but are not downloaded yet
+def download_missing_users(vk, storage, users_storage):
+    participants = storage.participants() | {vk.user_id}
+    users_ids_new = list(participants - users_storage.ids())
+    users_new = get_vk_users(vk, users_ids_new)
+    users_storage.add_users(users_new)
+
+
+# ids of users to download again, see vk_api.users_ttl
+def users_to_refresh(vk, users_storage):
+    refresh_ids = users_storage.stale_ids(vk.users_ttl,
+                                          vk.users_refresh_limit)
+    if len(refresh_ids) > 0:
+        logging.info('Refreshing %d users', len(refresh_ids))
+    return refresh_ids
+
+
+# yield (page, progress) pairs, 'progress' is the checkpoint to record
+# after the page is stored (None at the end); an interrupted download is
+# finished first, then messages newer than stored ones are downloaded
+def download_stream(vk, sent, storage_last_id, resume):
+    after_id = storage_last_id
+    if resume is not None:
+        after_id = resume['after_id']
+        # nothing was stored, just start again
+        if resume['min_id'] is None:
+            resume = None
+    if resume is not None:
+        progress = dict(resume)
+        for offset, page in get_vk_messages(vk, sent, after_id, resume):
+            update_progress(progress, page, offset)
+            yield page, dict(progress)
+        after_id = resume['max_id']
+    progress = {
+        'after_id': after_id,
+        'offset': 0,
+        'max_id': vk_message.no_id,
+        'min_id': None,
+    }
+    yield [], dict(progress)
+    for offset, page in get_vk_messages(vk, sent, after_id):
+        update_progress(progress, page, offset)
+        yield page, dict(progress)
+    yield [], None
+
+
+# for internal use
+def update_progress(progress, page, offset):
+    progress['offset'] = offset
+    if len(page) == 0:
+        return
+    ids = [msg.id() for msg in page]
+    progress['max_id'] = max([progress['max_id']] + ids)
+    if progress['min_id'] is not None:
+        ids.append(progress['min_id'])
+    progress['min_id'] = min(ids)
+
+
+# every page is written to the storage as soon as it is downloaded, so an
+# interrupted run keeps what it fetched; the checkpoint is saved only after
+# the storage is synced, that is done from time to time and when a stream
+# is finished; the next run continues from the checkpoint, messages that
+# are stored after it are downloaded again and skipped
+def store_page(storage, checkpoint, sent, page, progress):
+    storage.add_messages(page)
+    storage.flush()
+    checkpoint.set(sent, progress)
+    if progress is None or checkpoint.is_due():
+        storage.sync()
+        checkpoint.save()
+
+
+def download_sequential(vk, storage, users_storage):
+    checkpoint = vk_download_checkpoint(storage.storage_dir)
+    checkpoint.load()
+    # both streams start from the ids that are stored before the download
+    last_ids = [storage.last_id(sent) for sent in (True, False)]
+    for sent, last_id in zip((True, False), last_ids):
+        for page, progress in download_stream(vk, sent, last_id,
+                                              checkpoint.get(sent)):
+            store_page(storage, checkpoint, sent, page, progress)
+    download_missing_users(vk, storage, users_storage)
+    users_storage.add_users(
+        get_vk_users(vk, users_to_refresh(vk, users_storage)))
+
+
+# sent and received messages are paginated concurrently and users are
+# resolved along the way; all requests share vk's rate limiter and
+# connection pool, so the run is bound by the rate limit, not by latency
+def download_concurrent(vk, storage, users_storage):
+    checkpoint = vk_download_checkpoint(storage.storage_dir)
+    checkpoint.load()
+    resolver = users_resolver(vk, users_storage,
+                              users_to_refresh(vk, users_storage))
+    resolver.start()
+    # downloaded pages go to the storage in this thread
+    pages = queue.Queue(maxsize=16)
+    stopped = threading.Event()
+
+    def fetch(sent, last_id, resume):
+        try:
+            for page, progress in download_stream(vk, sent, last_id, resume):
+                if stopped.is_set():
+                    break
+                pages.put((sent, page, progress))
+        finally:
+            pages.put(None)
+
+    try:
+        with ThreadPoolExecutor(
+                max_workers=2,
+                thread_name_prefix=threading.current_thread().name) as pool:
+            futures = [pool.submit(fetch, sent, storage.last_id(sent),
+                                   checkpoint.get(sent))
+                       for sent in (True, False)]
+            running = len(futures)
+            try:
+                while running > 0:
+                    item = pages.get()
+                    if item is None:
+                        running -= 1
+                        continue
+                    sent, page, progress = item
+                    store_page(storage, checkpoint, sent, page, progress)
+                    resolver.add_messages(page)
+            except BaseException:
+                # fetching threads must not block on the full queue
+                stopped.set()
+                while running > 0:
+                    if pages.get() is None:
+                        running -= 1
+                raise
+            for future in futures:
+                future.result()
+    except BaseException:
+        resolver.abort()
+        raise
+    resolver.finish()
+    download_missing_users(vk, storage, users_storage)
+
+
+# (connect, read) timeouts for attached files
+attachment_timeout = (30, 300)
+
+
+# stream one file into a temporary file while hashing it, then move it into
+# the blob store; return its size or None if the download failed
+def download_attachment(session, attachments, key, url):
+    fd, tmp_filepath = tempfile.mkstemp(suffix='.part', dir=attachments.dir)
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with session.get(url, stream=True,
+                             timeout=attachment_timeout) as r:
+                r.raise_for_status()
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+    except (requests.RequestException, OSError) as e:
+        os.remove(tmp_filepath)
+        logging.warning('Cannot download %s (%s): %s', key, url, e)
+        attachments.add_failed(key, url, str(e))
+        return None
+    attachments.add(key, url, tmp_filepath, sha256.hexdigest(), size)
+    return size
+
+
+# files attached to stored messages, 'threads' downloads at once through
+# 'session' (see vk_api.session)
+def download_attachments(storage, threads, session):
+    attachments = vk_attachments_storage(storage.storage_dir,
+                                         type(storage.backend).__name__)
+    attachments.load()
+    files = attachments.missing_files(storage.dialogs.values())
+    if len(files) > 0:
+        logging.info('Downloading %d attachments...', len(files))
+        safe_mkdir(attachments.dir)
+
+        def download(item):
+            return download_attachment(session, attachments, *item)
+
+        done_cnt = 0
+        failed_cnt = 0
+        total_size = 0
+        with ThreadPoolExecutor(
+                max_workers=threads,
+                thread_name_prefix=threading.current_thread().name) as pool:
+            for size in pool.map(download, files):
+                if size is None:
+                    failed_cnt += 1
+                    continue
+                done_cnt += 1
+                total_size += size
+                if done_cnt % 1000 == 0:
+                    logging.info('%d of %d attachments downloaded',
+                                 done_cnt, len(files))
+        logging.info('%d attachments downloaded (%.1f MiB), %d failed',
+                     done_cnt, total_size / 2**20, failed_cnt)
+        storage.metrics.add('attachments_downloaded_total', done_cnt)
+        storage.metrics.add('attachments_failed_total', failed_cnt)
+        storage.metrics.add('attachments_bytes_total', total_size)
+    attachments.save()
+
+
 # Main
 # ====
 
@@ -591,38 +3613,354 @@ def main():
 
     log_level = logging.WARNING if args.quiet else logging.INFO
     logging.getLogger().setLevel(log_level)
-    prettify_logging()
 
-    vk = vk_api(args.config)
+    config_file = find_config(args.config)
+    accounts = read_accounts(config_file)
+    account = None
+    if accounts is not None and \
+            (args.account is not None or args.command in ('search', 'export')):
+        account = find_account(accounts, args.account)
+        args = account_args(args, account)
+        accounts = None
+    prettify_logging(thread_names=accounts is not None)
+
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if accounts is not None:
+            backup_accounts(args, config_file, accounts)
+            return
+        vk = vk_api(config_file, account)
+        tz = create_timezone(args.timezone or vk.timezone)
+        if args.command == 'search':
+            search(args, vk, tz)
+        elif args.command == 'export':
+            export(args, vk, tz)
+        else:
+            backup(args, vk, tz)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        # backup_accounts() saves metrics of the accounts itself
+        if args.metrics is not None and accounts is None:
+            metrics.save(args.metrics)
+
+
+def backup(args, vk, tz):
+    # load saved messages and users
+    storage = vk_messages_storage(args.storage, args.chatlogs,
+                                  args.storage_format, tz)
+    storage.metrics = vk.metrics
+    with vk.metrics.stage('load_messages'):
+        storage.load()
+    users_storage = vk_users_storage(args.storage)
+    with vk.metrics.stage('load_users'):
+        users_storage.load()
+    # load new messages and missing users
+    with vk.metrics.stage('download'):
+        if args.sequential:
+            download_sequential(vk, storage, users_storage)
+        else:
+            download_concurrent(vk, storage, users_storage)
+    # save all messages and users
+    with vk.metrics.stage('save_messages'):
+        storage.save()
+    with vk.metrics.stage('save_users'):
+        users_storage.save()
+
+    # dump all messages
+    users_dict = users_storage.users_dict(vk.user_id)
+    with vk.metrics.stage('render'):
+        storage.dump(users_dict, args.jobs)
+    if args.attachments:
+        with vk.metrics.stage('attachments'):
+            download_attachments(storage, vk.attachments_threads,
+                                 vk.session)
+    stages = vk.metrics.report()['stage_seconds']
+    logging.info('Done in %.1fs: %s', sum(stages.values()),
+                 ', '.join('%s %.1fs' % item for item in stages.items()))
+    try:
+        if args.daemon:
+            daemon(args, vk, storage, users_storage)
+    finally:
+        storage.close()
+
+
+# "accounts" of a multi-account config or None for a usual one
+def read_accounts(config_file):
+    if config_file is None or not os.path.isfile(config_file):
+        return None
+    with open(config_file, 'r') as f:
+        accounts = json.load(f).get('accounts')
+    if accounts is None:
+        return None
+    if len(accounts) == 0:
+        raise NameError('read_accounts: no accounts in %s' % config_file)
+    return accounts
+
+
+def account_name(account):
+    return str(account.get('name', account['user_id']))
+
+
+# 'name' is a user_id or a name, None is fine for one account
+def find_account(accounts, name):
+    if name is None:
+        if len(accounts) == 1:
+            return accounts[0]
+        raise NameError('find_account: the config lists several accounts, '
+                        'choose one with --account')
+    for account in accounts:
+        if name in (account_name(account), str(account['user_id'])):
+            return account
+    raise NameError('find_account: unknown account: %s' % name)
+
+
+# 'args' with the storage and chatlogs of 'account': its own "storage" and
+# "chatlogs" or subdirectories of --storage and --chatlogs
+def account_args(args, account):
+    res = Namespace(**vars(args))
+    name = account_name(account)
+    res.storage = account.get('storage', os.path.join(args.storage, name))
+    res.chatlogs = account.get('chatlogs', os.path.join(args.chatlogs, name))
+    return res
+
+
+# default of "max_concurrent_accounts" in a multi-account config
+default_max_concurrent_accounts = 4
+
+
+# back up all accounts, up to "max_concurrent_accounts" at once (all of
+# them with --daemon, as a daemon never finishes); every account has its
+# own rate limiter (accounts with the same token share it) and metrics,
+# HTTP connections and downloaded users are shared; a failed account does
+# not stop others
+def backup_accounts(args, config_file, accounts):
+    with open(config_file, 'r') as f:
+        config_data = json.load(f)
+    max_workers = config_data.get('max_concurrent_accounts',
+                                  default_max_concurrent_accounts)
+    if args.daemon:
+        max_workers = len(accounts)
+        signal.signal(signal.SIGTERM, stop_daemon)
+    max_workers = min(max_workers, len(accounts))
+    attachments_threads = max(
+        account.get('attachments_threads', config_data.get(
+            'attachments_threads', vk_api.default_attachments_threads))
+        for account in accounts)
+    session = vk_api.create_session(
+        max(vk_api.pool_size, attachments_threads) * max_workers)
+    users_cache = vk_users_cache()
+    limiters = dict()
+    limiters_lock = threading.Lock()
+    # run_metrics of the accounts
+    metrics_group = []
+
+    def run(account):
+        threading.current_thread().name = account_name(account)
+        vk = vk_api(config_file, account, session)
+        with limiters_lock:
+            vk.limiter = limiters.setdefault(vk.access_token, vk.limiter)
+            vk.metrics = run_metrics(account_name(account), metrics_group)
+        vk.users_cache = users_cache
+        tz = create_timezone(args.timezone or vk.timezone)
+        backup(account_args(args, account), vk, tz)
+
+    # per account directories are created by backup()
+    safe_mkdir(args.storage)
+    safe_mkdir(args.chatlogs)
+    logging.info('Backing up %d accounts, %d at once', len(accounts),
+                 max_workers)
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(run, account) for account in accounts]
+            try:
+                for account, future in zip(accounts, futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error('Backup of %s failed: %s',
+                                      account_name(account), e)
+                        failed.append(account_name(account))
+            except BaseException:
+                # daemons finish their current updates, the pool waits for
+                # them
+                daemon_stopped.set()
+                raise
+    finally:
+        if args.metrics is not None and len(metrics_group) > 0:
+            metrics_group[0].save(args.metrics)
+    if len(failed) > 0:
+        raise NameError('backup_accounts: failed accounts: %s' %
+                        ', '.join(failed))
+
+
+# set to stop all daemons, see daemon()
+daemon_stopped = threading.Event()
+
+
+def stop_daemon(signum, frame):
+    logging.info('Stopping on signal %d', signum)
+    daemon_stopped.set()
+    sys.exit(0)
+
+
+# keep the storages loaded and download new messages when the long poll
+# server reports them, or every 'poll_interval' seconds if it is not
+# available; API errors that retries did not help against are waited out
+# the same way, only fatal ones (like a revoked token) stop the daemon
+def daemon(args, vk, storage, users_storage):
+    # backup_accounts() runs daemons in threads and handles signals itself
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, stop_daemon)
+    if args.metrics is not None:
+        vk.metrics.save(args.metrics)
+    long_poll = vk_long_poll(vk)
+    logging.info('Waiting for new messages...')
+    while not daemon_stopped.is_set():
+        try:
+            if long_poll is None:
+                daemon_stopped.wait(args.poll_interval)
+            elif not long_poll.wait_messages():
+                continue
+        except vk_api_error as e:
+            if e.kind == 'fatal':
+                logging.warning('Long poll is not available (%s), checking '
+                                'for new messages every %.0fs', e,
+                                args.poll_interval)
+                long_poll = None
+                continue
+            logging.warning('Long poll failed: %s', e)
+            daemon_stopped.wait(args.poll_interval)
+        except (requests.RequestException, ValueError) as e:
+            logging.warning('Long poll failed: %s', e)
+            long_poll.key = None
+            daemon_stopped.wait(args.poll_interval)
+        if daemon_stopped.is_set():
+            break
+        try:
+            sync_new_messages(args, vk, storage, users_storage)
+        except vk_api_error as e:
+            if e.kind == 'fatal':
+                raise
+            logging.warning('Download of new messages failed: %s', e)
+        if args.metrics is not None:
+            vk.metrics.save(args.metrics)
+
+
+# download new messages into the resident storages, save and render only
+# dialogs with new messages or with renamed (or just downloaded) users
+def sync_new_messages(args, vk, storage, users_storage):
+    old_users_dict = users_storage.users_dict(vk.user_id)
+    with vk.metrics.stage('download'):
+        download_concurrent(vk, storage, users_storage)
+    dialog_ids = storage.dirty_dialogs | storage.flushed_dialogs
+    with vk.metrics.stage('save_messages'):
+        storage.save()
+    with vk.metrics.stage('save_users'):
+        users_storage.save()
 
-    # load saved messages
-    storage = vk_messages_storage(args.storage, args.chatlogs)
+    users_dict = users_storage.users_dict(vk.user_id)
+    renamed_ids = set(user_id for user_id, user in users_dict.items()
+                      if user_id != 'me' and
+                      str(user) != str(old_users_dict.get(user_id)))
+    if vk.user_id in renamed_ids:
+        # 'me' is in every chatlog
+        dialog_ids = None
+    elif len(renamed_ids) > 0:
+        for dialog_id, dialog in storage.dialogs.items():
+            if not renamed_ids.isdisjoint(dialog.participants()):
+                dialog_ids.add(dialog_id)
+    if dialog_ids is not None and len(dialog_ids) == 0:
+        return
+    with vk.metrics.stage('render'):
+        storage.dump(users_dict, args.jobs, dialog_ids)
+    if args.attachments:
+        with vk.metrics.stage('attachments'):
+            download_attachments(storage, vk.attachments_threads,
+                                 vk.session)
+    # messages are read again when needed
+    for dialog in storage.dialogs.values():
+        dialog.unload()
+
+
+def export(args, vk, tz):
+    storage = vk_messages_storage(args.storage, args.chatlogs,
+                                  args.storage_format, tz)
+    storage.search_index.is_disabled = True
+    exporter = vk_exporter(args.output, args.format,
+                           type(storage.backend).__name__,
+                           int(args.chunk_size * 2**20))
     storage.load()
-    # load new messages
-    sent_messages = get_vk_messages(
-        vk, sent=True, after_id=storage.last_id(sent=True))
-    recv_messages = get_vk_messages(
-        vk, sent=False, after_id=storage.last_id(sent=False))
-    storage.add_messages(sent_messages)
-    storage.add_messages(recv_messages)
-    # save all messages
-    storage.save()
-
-    participants = storage.participants()
-
-    # load saved users
     users_storage = vk_users_storage(args.storage)
     users_storage.load()
-    # load missing users
-    users_ids_new = list(participants - users_storage.ids())
-    users_new = get_vk_users(vk, users_ids_new)
-    users_storage.add_users(users_new)
-    # save all users
-    users_storage.save()
+    users_dict = users_storage.users_dict(vk.user_id)
+    exporter.load()
+    exporter.export(storage, users_dict, tz)
+    storage.close()
 
-    # dump all messages
+
+# 'YYYY-MM-DD' -> unix time of the day start in 'tz'
+def parse_day(day, tz):
+    try:
+        dt = datetime.strptime(day, '%Y-%m-%d')
+    except ValueError:
+        raise NameError('parse_day: expected YYYY-MM-DD, got %s' % day)
+    return int(dt.replace(tzinfo=tz).timestamp())
+
+
+def search(args, vk, tz):
+    storage = vk_messages_storage(args.storage, args.chatlogs,
+                                  args.storage_format, tz)
+    storage.load()
+    users_storage = vk_users_storage(args.storage)
+    users_storage.load()
     users_dict = users_storage.users_dict(vk.user_id)
-    storage.dump(users_dict)
+
+    dialog_name = None
+    if args.dialog is not None:
+        for dialog in storage.dialogs.values():
+            if args.dialog in (dialog.name(), dialog.title(users_dict)):
+                dialog_name = dialog.name()
+                break
+        else:
+            raise NameError('search: unknown dialog: %s' % args.dialog)
+    user_id = None
+    out = None
+    if args.author == 'me' or args.author == str(vk.user_id):
+        out = True
+    elif args.author is not None:
+        try:
+            user_id = int(args.author)
+        except ValueError:
+            raise NameError('search: expected a user id or "me" as an '
+                            'author, got %s' % args.author)
+        out = False
+    since = None if args.since is None else parse_day(args.since, tz)
+    until = None
+    if args.until is not None:
+        until = parse_day(args.until, tz) + 24 * 60 * 60
+
+    start_time = time.monotonic()
+    rows = storage.search_index.search(
+        ' '.join(args.query), dialog_name, user_id, out, since, until,
+        args.limit, args.fts)
+    elapsed = time.monotonic() - start_time
+
+    formatter = vk_message_formatter(users_dict, tz)
+    for name, user_id, out, date, snippet in rows:
+        dialog = storage.dialogs[vk_dialog.name_to_id(name)]
+        username = formatter.format_username({'out': out,
+                                              'user_id': user_id})
+        print('%s: [%s] %s: %s' % (dialog.title(users_dict),
+                                   formatter.format_timestamp(date),
+                                   username, snippet.replace('\n', ' ')))
+    logging.info('%d messages found in %.1f ms', len(rows), elapsed * 1000)
+    storage.close()
 
 if __name__ == '__main__':
     main()